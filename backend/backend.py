@@ -64,23 +64,46 @@ class BackendChannel(asynchat.async_chat):
     """
     def __init__(self, backend, sock):
         self.backend = backend
-        self.received_data = []
+        self.decoder = StreamDecoder()
         asynchat.async_chat.__init__(self, sock)
         self.ac_in_buffer_size = 4096 * 3
         self.ac_out_buffer_size = 4096 * 3
-        self.set_terminator(TERM_CHAR)
+        self.binary = False         # set once the client sends BINARY_HELLO
+        self.batch = False          # set once the client sends BATCH_HELLO
+        # message boundaries are tracked by the decoder, not by asynchat
+        self.set_terminator(None)
         return
 
+    def encode(self, msg, binary):
+        if binary:
+            return encode_binary(msg)
+        else:
+            return serialize(msg)
+
     def collect_incoming_data(self, data):
-        """Read an incoming message from the backend and put it into our outgoing queue."""
+        """Read incoming data from the backend and handle each message completed by it."""
         with self.backend.channel_lock:
-            self.received_data.append(data)
+            messages = self.decoder.feed(data)
+            if self.decoder.batch and not self.batch:
+                # the client handles batch messages: acknowledge
+                self.push(BATCH_HELLO + TERM_CHAR)
+                self.batch = True
+            if self.decoder.binary and not self.binary:
+                # the client speaks the binary format: acknowledge and switch
+                self.push(BINARY_HELLO + TERM_CHAR)
+                self.binary = True
+        for msg in messages:
+            self.handle_message(msg)
+        if self.decoder.error is not None:
+            print "ERROR: %s, closing backend channel" % self.decoder.error
+            self.close()
 
     def found_terminator(self):
-        """The end of a command or message has been seen."""
-        with self.backend.channel_lock:
-            msg = deserialize(self.received_data)
+        """Not called, as the channel has no terminator."""
+        pass
 
+    def handle_message(self, msg):
+        """Dispatch a message from the backend to the runtime."""
         # USE DESERIALIZED MSG
         if msg is None or len(msg) == 0:
             print "ERROR: empty message"
@@ -136,6 +159,28 @@ class Backend(object):
     def send_install(self,pred,priority,action_list):
         self.send_to_OF_client(['install',pred,priority,action_list])
 
+    def send_install_many(self,rules):
+        if self.batching():
+            self.send_batches('install_many',rules)
+        else:
+            for (pred,priority,action_list) in self.ungroup(rules):
+                self.send_install(pred,priority,action_list)
+
+    def send_modify_many(self,rules):
+        if self.batching():
+            self.send_batches('modify_many',rules)
+        else:
+            for (pred,priority,action_list) in self.ungroup(rules):
+                self.send_delete(pred,priority)
+                self.send_install(pred,priority,action_list)
+
+    def send_delete_many(self,rules):
+        if self.batching():
+            self.send_batches('delete_many',rules)
+        else:
+            for (pred,priority) in self.ungroup(rules):
+                self.send_delete(pred,priority)
+
     def send_delete(self,pred,priority):
         self.send_to_OF_client(['delete',pred,priority])
         
@@ -151,8 +196,43 @@ class Backend(object):
     def inject_discovery_packet(self,dpid, port):
         self.send_to_OF_client(['inject_discovery_packet',dpid,port])
 
+    def batching(self):
+        """
+        Whether the OF client announced that it handles batch messages.
+        """
+        channel = self.backend_channel
+        return channel is not None and channel.batch
+
+    def ungroup(self,rules):
+        """
+        The rules of a batch, [switches, pred, priority, ...] each, as one
+        (pred on a switch, priority, ...) tuple per switch.
+        """
+        for rule in rules:
+            for switch in rule[0]:
+                pred = dict(rule[1])
+                pred['switch'] = switch
+                yield tuple([pred] + list(rule[2:]))
+
+    def send_batches(self,kind,rules):
+        """
+        Send rules to the OF client in messages of at most RULE_BATCH_SIZE
+        rules each.  Each rule is [switches, pred, priority, ...] and
+        applies to every switch listed.
+        """
+        for i in xrange(0, len(rules), RULE_BATCH_SIZE):
+            self.send_to_OF_client([kind, rules[i:i+RULE_BATCH_SIZE]])
+
     def send_to_OF_client(self,msg):
-        serialized_msg = serialize(msg)
+        channel = self.backend_channel
+        if channel is None:
+            return
+        binary = channel.binary
+        serialized_msg = channel.encode(msg,binary)
         with self.channel_lock:
             if not self.backend_channel is None:
-                self.backend_channel.push(serialized_msg)
+                channel = self.backend_channel
+                if channel.binary != binary:
+                    # the format was switched while encoding
+                    serialized_msg = channel.encode(msg,channel.binary)
+                channel.push(serialized_msg)
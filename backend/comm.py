@@ -32,9 +32,22 @@ import asyncore
 import socket
 
 import json
+import struct
 
 BACKEND_PORT=41414
 TERM_CHAR='\n'
+RULE_BATCH_SIZE=1000
+
+# Sent by a client that speaks the binary format as its first message, and
+# echoed back by the backend, after which both directions use binary frames:
+# a 4-byte big-endian length followed by an encoded message.
+BINARY_HELLO='PYRETIC-BINARY-1'
+# Sent by a client that handles install_many, modify_many and delete_many
+# messages, before any BINARY_HELLO, and echoed back by the backend.  Other
+# clients get a message per rule and switch.
+BATCH_HELLO='PYRETIC-BATCH-1'
+FRAME_HEADER_SIZE=4
+MAX_MESSAGE_SIZE=64 * 1024 * 1024
 
 def serialize(msg):
     jsonable_msg = to_jsonable_format(msg)
@@ -108,3 +121,210 @@ def to_jsonable_format(item):
         return map(to_jsonable_format,item)
     else:
         return item
+
+
+def encode_binary(msg):
+    """
+    Encode msg as a binary frame.  Values are tagged: None, booleans,
+    integers, floats, strings (passed through as raw bytes), lists and
+    dicts.  Dicts are converted as in the JSON format (see dict_to_ascii),
+    but string values such as MACs, IPs and raw payloads are not expanded.
+    """
+    parts = []
+    def encode(item):
+        if item is None:
+            parts.append('n')
+        elif item is True:
+            parts.append('t')
+        elif item is False:
+            parts.append('f')
+        elif isinstance(item, (int, long)):
+            if -(1 << 63) <= item < (1 << 63):
+                parts.append('i' + struct.pack('>q', item))
+            else:
+                digits = str(item)
+                parts.append('b' + struct.pack('>I', len(digits)) + digits)
+        elif isinstance(item, float):
+            parts.append('d' + struct.pack('>d', item))
+        elif isinstance(item, basestring):
+            if isinstance(item, unicode):
+                item = item.encode('utf-8')
+            parts.append('s' + struct.pack('>I', len(item)))
+            parts.append(item)
+        elif isinstance(item, (list, tuple)):
+            parts.append('l' + struct.pack('>I', len(item)))
+            for i in item:
+                encode(i)
+        elif isinstance(item, dict):
+            item = dict_to_ascii(item)
+            parts.append('m' + struct.pack('>I', len(item)))
+            for (k, v) in item.items():
+                encode(k)
+                encode(v)
+        else:
+            raise TypeError('cannot encode %r' % (item,))
+    encode(msg)
+    payload = ''.join(parts)
+    return struct.pack('>I', len(payload)) + payload
+
+
+def frame_length(header):
+    """
+    The length of the payload of the frame starting with header.
+    """
+    return struct.unpack('>I', header)[0]
+
+
+def decode_binary(payload):
+    """
+    Decode the payload of a binary frame (without its length header).
+    """
+    unpack_from = struct.unpack_from
+    def decode(pos):
+        tag = payload[pos]
+        pos += 1
+        if tag == 'i':
+            return (unpack_from('>q', payload, pos)[0], pos + 8)
+        elif tag == 's':
+            n = unpack_from('>I', payload, pos)[0]
+            pos += 4
+            return (payload[pos:pos+n], pos + n)
+        elif tag == 'l':
+            n = unpack_from('>I', payload, pos)[0]
+            pos += 4
+            items = []
+            for _ in xrange(n):
+                (item, pos) = decode(pos)
+                items.append(item)
+            return (items, pos)
+        elif tag == 'm':
+            n = unpack_from('>I', payload, pos)[0]
+            pos += 4
+            d = {}
+            for _ in xrange(n):
+                (k, pos) = decode(pos)
+                (d[k], pos) = decode(pos)
+            return (d, pos)
+        elif tag == 'n':
+            return (None, pos)
+        elif tag == 't':
+            return (True, pos)
+        elif tag == 'f':
+            return (False, pos)
+        elif tag == 'd':
+            return (unpack_from('>d', payload, pos)[0], pos + 8)
+        elif tag == 'b':
+            n = unpack_from('>I', payload, pos)[0]
+            pos += 4
+            return (long(payload[pos:pos+n]), pos + n)
+        else:
+            raise ValueError('bad tag %r at %d' % (tag, pos - 1))
+    (msg, pos) = decode(0)
+    if pos != len(payload):
+        raise ValueError('%d trailing bytes' % (len(payload) - pos))
+    return msg
+
+
+class StreamDecoder(object):
+    """
+    Splits the data received on the backend channel into messages,
+    newline-terminated JSON until the client sends BINARY_HELLO and binary
+    frames after that, and decodes each message once it is complete.  Data
+    of an incomplete message is kept as a list of chunks, so each byte is
+    looked at a bounded number of times, and is limited to
+    max_message_size bytes.  Once a message is too large or can't be
+    decoded, the stream can't be split any further: the decoder keeps the
+    error in self.error and ignores the rest of the data.
+
+    :param max_message_size: the largest message accepted, in bytes
+    :type max_message_size: int
+    """
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        self.binary = False
+        self.batch = False          # set once the client sends BATCH_HELLO
+        self.chunks = []            # data of the incomplete message
+        self.size = 0               # total length of self.chunks
+        self.frame_length = None    # payload length of the binary frame being read
+        self.error = None           # the ValueError that stopped decoding
+
+    def feed(self, data):
+        """
+        Add received data.  If a message is larger than max_message_size
+        or can't be decoded, self.error is set, and the messages completed
+        before it are still returned.
+
+        :param data: the data received
+        :type data: str
+        :returns: the messages completed by data, in order
+        :rtype: list
+        """
+        messages = []
+        if self.error is not None:
+            return messages
+        try:
+            while data:
+                if self.binary:
+                    data = self._feed_binary(data, messages)
+                else:
+                    data = self._feed_json(data, messages)
+        except ValueError as e:
+            self.error = e
+            self.chunks = []
+            self.size = 0
+        return messages
+
+    def _keep(self, data):
+        if self.size + len(data) > self.max_message_size:
+            raise ValueError('message larger than %d bytes' %
+                             self.max_message_size)
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def _take(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+    def _feed_json(self, data, messages):
+        end = data.find(TERM_CHAR)
+        if end < 0:
+            self._keep(data)
+            return ''
+        self._keep(data[:end])
+        line = self._take()
+        if line == BINARY_HELLO:
+            self.binary = True
+        elif line == BATCH_HELLO:
+            self.batch = True
+        else:
+            messages.append(deserialize([line]))
+        return data[end+len(TERM_CHAR):]
+
+    def _feed_binary(self, data, messages):
+        if self.frame_length is None:
+            wanted = FRAME_HEADER_SIZE - self.size
+        else:
+            wanted = self.frame_length - self.size
+        if len(data) < wanted:
+            self._keep(data)
+            return ''
+        self._keep(data[:wanted])
+        complete = self._take()
+        if self.frame_length is None:
+            length = frame_length(complete)
+            if length > self.max_message_size:
+                raise ValueError('message larger than %d bytes' %
+                                 self.max_message_size)
+            if length == 0:
+                messages.append(None)
+            else:
+                self.frame_length = length
+        else:
+            self.frame_length = None
+            try:
+                messages.append(decode_binary(complete))
+            except (struct.error, IndexError) as e:
+                raise ValueError('bad frame: %s' % e)
+        return data[wanted:]
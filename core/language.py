@@ -35,11 +35,13 @@ import functools
 import itertools
 import struct
 import time
+import weakref
 from ipaddr import IPv4Network
 from bitarray import bitarray
 
 from pyretic.core import util
 from pyretic.core.network import *
+from pyretic.core.network import _netmask
 from pyretic.core.util import frozendict, singleton
 
 from multiprocessing import Condition
@@ -77,15 +79,51 @@ class Policy(object):
     def dry_eval(self, pkt):
         return self.eval(pkt)
 
+    def track_eval(self, pkt, dry=False):
+        """
+        evaluate this policy on a single packet, also collecting the
+        queries the packet reaches along the way
+
+        :param pkt: the packet on which to be evaluated
+        :type pkt: Packet
+        :param dry: whether to leave query buckets untouched
+        :type dry: bool
+        :rtype: (set Packet, set Query)
+        """
+        if dry:
+            return (self.dry_eval(pkt), set())
+        else:
+            return (self.eval(pkt), set())
+
+    def compile_eval(self):
+        """
+        Produce a function that evaluates this policy on a single packet,
+        specialised to the structure of this policy.  Any DynamicPolicy
+        below this policy recompiles its own part of the function when
+        it changes.  When passed a set of queries, the function adds to
+        it each Query the packet reaches.
+
+        :rtype: (Packet, set Query) -> set Packet
+        """
+        return _eval_fn(self)
 
     def compile(self):
         """
-        Produce a Classifier for this policy
+        Produce a Classifier for this policy.  The classifier may be
+        shared with later calls, so it must not be modified.
 
         :rtype: Classifier
         """
         raise NotImplementedError
 
+    def compile_key(self):
+        """
+        A value that changes whenever the output of self.compile() may
+        change, or None if it never does.  Compiled classifiers are kept
+        and reused for as long as this value stays the same.
+        """
+        return None
+
     def __add__(self, pol):
         """
         The parallel composition operator.
@@ -197,11 +235,224 @@ class Filter(Policy):
         return negate([self])
 
 
+def _overrides_eval(policy, cls):
+    """
+    Whether the class of policy redefines the eval it inherits from cls,
+    in which case closure compilation must defer to that eval.
+    """
+    return type(policy).eval.im_func is not cls.eval.im_func
+
+
+def _eval_fn(policy):
+    """
+    Wrap the eval of a policy that closure compilation can't look inside.
+    """
+    def eval_fn(pkt, queries=None):
+        if queries is None:
+            return policy.eval(pkt)
+        output, reached = policy.track_eval(pkt)
+        queries |= reached
+        return output
+    return eval_fn
+
+
+_interned_nodes = weakref.WeakValueDictionary()
+
+def _intern(cls, node_map):
+    """
+    The node of class cls with map node_map.  While such a node is alive,
+    building an equal one returns it instead of a new object, so that
+    equal nodes are usually identical and compare in constant time.
+
+    :param cls: the class of the node (match or modify)
+    :type cls: type
+    :param node_map: the map of the node
+    :type node_map: frozendict
+    """
+    try:
+        key = (cls, frozenset((field, type(value), value)
+                              for (field, value) in node_map.iteritems()))
+        node = _interned_nodes.get(key)
+    except TypeError:   # UNHASHABLE VALUES ARE NOT SHARED
+        key = node = None
+    if node is None:
+        node = object.__new__(cls)
+        node.map = node_map
+        if key is not None:
+            _interned_nodes[key] = node
+    return node
+
+
+def _memoize_compile(compile_fn):
+    """
+    Wrap a compile method so that its classifier is reused until the
+    policy's compile_key changes.
+    """
+    @functools.wraps(compile_fn)
+    def compile(self):
+        key = self.compile_key()
+        cached = self.__dict__.get('_compiled')
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        classifier = compile_fn(self)
+        self._compiled = (key, classifier)
+        return classifier
+    return compile
+
+
+def _balanced_reduce(fn, items):
+    """
+    Combine items pairwise with fn, as reduce does, but as a balanced
+    tree, so that intermediate results stay small.
+
+    :param fn: an associative binary function
+    :param items: a non-empty list
+    """
+    items = list(items)
+    while len(items) > 1:
+        paired = [fn(items[i], items[i+1]) for i in xrange(0, len(items) - 1, 2)]
+        if len(items) % 2:
+            paired.append(items[-1])
+        items = paired
+    return items[0]
+
+
+_compile_pool = None
+
+def set_compile_processes(processes):
+    """
+    Compile the independent branches of parallel and sequential policies
+    in a pool of worker processes.  Only branches with no queries and no
+    dynamic policies are sent to the pool; the rest compile in this
+    process.
+
+    :param processes: the number of worker processes, or None to compile
+        everything in this process
+    :type processes: int
+    """
+    global _compile_pool
+    from multiprocessing import Pool
+    if _compile_pool is not None:
+        _compile_pool.terminate()
+        _compile_pool = None
+    if processes:
+        _compile_pool = Pool(processes, initializer=_init_compile_worker)
+
+
+def _init_compile_worker():
+    # workers inherit the parent's pool reference, but must not use it
+    global _compile_pool
+    _compile_pool = None
+
+
+def _compile_policy(policy):
+    return policy.compile()
+
+
+def _shippable(policy):
+    """
+    Whether policy is worth compiling in another process, and can be: it
+    must not change (compile_key is None) and must hold no queries, whose
+    callbacks stay in this process.
+    """
+    if not isinstance(policy, (CombinatorPolicy, DerivedPolicy)):
+        return False
+    if policy.compile_key() is not None:
+        return False
+    def check(acc, p):
+        return acc and not isinstance(p, (Query, DynamicPolicy))
+    try:
+        return ast_fold(check, True, policy)
+    except NotImplementedError:
+        return False
+
+
+def _compile_all(policies):
+    """
+    Compile each of policies, using the compile pool when there is one.
+
+    :rtype: list Classifier
+    """
+    if _compile_pool is None or len(policies) < 2:
+        return [p.compile() for p in policies]
+    shipped = [i for (i, p) in enumerate(policies)
+               if p.__dict__.get('_compiled') is None and _shippable(p)]
+    if len(shipped) < 2:
+        return [p.compile() for p in policies]
+    results = _compile_pool.map_async(_compile_policy,
+                                      [policies[i] for i in shipped])
+    classifiers = [None] * len(policies)
+    local = set(xrange(len(policies))) - set(shipped)
+    for (i, p) in enumerate(policies):
+        if i in local:
+            classifiers[i] = p.compile()
+    for (i, classifier) in zip(shipped, results.get()):
+        policies[i]._compiled = (None, classifier)
+        classifiers[i] = classifier
+    return classifiers
+
+
+def _ip_within(ipfx, opfx):
+    """
+    Whether IP prefix or address ipfx lies within opfx.
+    """
+    if ( isinstance(ipfx, (IPPrefix, IPAddr)) and
+         isinstance(opfx, (IPPrefix, IPAddr)) ):
+        (iaddr, ilen) = ipfx.network()
+        (oaddr, olen) = opfx.network()
+        return ilen >= olen and (iaddr & _netmask(olen)) == oaddr
+    return IPv4Network(ipfx) in IPv4Network(opfx)
+
+
+# FIELD WIDTHS OF THE TERNARY (VALUE/MASK) ENCODING OF MATCHES
+ternary_widths = [("srcmac", 48), ("dstmac", 48), ("srcip", 32), ("dstip", 32),
+                  ("tos", 8), ("srcport", 16), ("dstport", 16), ("ethtype", 16),
+                  ("protocol", 8), ("vlan_id", 16), ("vlan_pcp", 8),
+                  ("switch", 64), ("inport", 32), ("outport", 32)]
+
+_ternary_offsets = {}
+_offset = 0
+for (_field, _width) in ternary_widths:
+    _ternary_offsets[_field] = (_offset, _width)
+    _offset += _width
+del _offset, _field, _width
+
+
+def _ternary_field(field, pattern):
+    """
+    The (value, mask) encoding of matching field against pattern, or
+    None if the pattern has no such encoding.
+    """
+    try:
+        offset, width = _ternary_offsets[field]
+    except KeyError:
+        return None
+    if field == 'srcip' or field == 'dstip':
+        if not isinstance(pattern, (IPPrefix, IPAddr)):
+            return None
+        addr, masklen = pattern.network()
+        if masklen == 0:
+            return None
+        return (addr << offset, _netmask(masklen) << offset)
+    elif field == 'srcmac' or field == 'dstmac':
+        if not isinstance(pattern, EthAddr):
+            return None
+        value = pattern.value
+    elif isinstance(pattern, (int, long)):
+        value = pattern
+    else:
+        return None
+    full = (1 << width) - 1
+    if not 0 <= value <= full:
+        return None
+    return (value << offset, full << offset)
+
+
 def _intersect_ip(ipfx, opfx):
     most_specific = None
-    if (IPv4Network(ipfx) in IPv4Network(opfx)):
+    if _ip_within(ipfx, opfx):
         most_specific = ipfx
-    elif (IPv4Network(opfx) in IPv4Network(ipfx)): 
+    elif _ip_within(opfx, ipfx):
         most_specific = opfx
     return most_specific
 
@@ -214,11 +465,13 @@ class match(Filter):
     :param *args: field matches in argument format
     :param **kwargs: field matches in keyword-argument format
     """
-    def __init__(self, *args, **kwargs):
+    def __new__(cls, *args, **kwargs):
         if len(args) == 0 and len(kwargs) == 0:
             raise TypeError
-        self.map = util.frozendict(dict(*args, **kwargs))
-        super(match,self).__init__()
+        return _intern(cls, util.frozendict(dict(*args, **kwargs)))
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self.map),))
 
     def eval(self, pkt):
         """
@@ -239,6 +492,39 @@ class match(Filter):
                     return set()
         return {pkt}
 
+    def compile_eval(self):
+        """
+        Produce a function equivalent to self.eval
+
+        :rtype: Packet -> set Packet
+        """
+        if _overrides_eval(self, match):
+            return _eval_fn(self)
+        items = tuple(self.map.items())
+        if len(items) == 1:
+            [(field, pattern)] = items
+            def eval_fn(pkt, queries=None):
+                try:
+                    v = pkt[field]
+                    if pattern is None or pattern != v:
+                        return set()
+                except:
+                    if pattern is not None:
+                        return set()
+                return {pkt}
+            return eval_fn
+        def eval_fn(pkt, queries=None):
+            for field, pattern in items:
+                try:
+                    v = pkt[field]
+                    if pattern is None or pattern != v:
+                        return set()
+                except:
+                    if pattern is not None:
+                        return set()
+            return {pkt}
+        return eval_fn
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -250,9 +536,34 @@ class match(Filter):
         return Classifier([r1, r2])
 
     def __eq__(self, other):
-        return ( (isinstance(other, match) and self.map == other.map)
+        return ( self is other
+            or (isinstance(other, match) and self.map == other.map)
             or (other == identity and len(self.map) == 0) )
 
+    def ternary(self):
+        """
+        The encoding of this match as a (value, mask) pair of integers
+        over the fields in ternary_widths: a packet matches if its fields,
+        encoded the same way, agree with value wherever mask is set.
+        None if some field or pattern has no such encoding.
+
+        :rtype: (int, int)
+        """
+        try:
+            return self._ternary
+        except AttributeError:
+            pass
+        value = mask = 0
+        for (field, pattern) in self.map.iteritems():
+            encoded = _ternary_field(field, pattern)
+            if encoded is None:
+                value = mask = None
+                break
+            value |= encoded[0]
+            mask |= encoded[1]
+        self._ternary = None if mask is None else (value, mask)
+        return self._ternary
+
     def intersect(self, pol):
         if pol == identity:
             return self
@@ -260,6 +571,20 @@ class match(Filter):
             return drop
         elif not isinstance(pol,match):
             raise TypeError
+        t1 = self.ternary()
+        t2 = pol.ternary()
+        if t1 is not None and t2 is not None:
+            (v1, m1), (v2, m2) = t1, t2
+            if (v1 ^ v2) & m1 & m2:
+                return drop
+            d = self.map.update(pol.map)
+            for f in ('srcip', 'dstip'):
+                if ( f in self.map and f in pol.map and
+                     self.map[f].network()[1] >= pol.map[f].network()[1] ):
+                    d = d.update({f : self.map[f]})
+            intersection = match(**d)
+            intersection._ternary = (v1 | v2, m1 | m2)
+            return intersection
         fs1 = set(self.map.keys())
         fs2 = set(pol.map.keys())
         shared = fs1 & fs2
@@ -306,13 +631,17 @@ class match(Filter):
             return True
         elif other == drop:
             return True
+        t1 = self.ternary()
+        t2 = other.ternary()
+        if t1 is not None and t2 is not None:
+            (v1, m1), (v2, m2) = t1, t2
+            return not (m1 & ~m2) and not ((v1 ^ v2) & m1)
         if set(self.map.keys()) - set(other.map.keys()):
             return False
         for (f,v) in self.map.items():
             if (f=='srcip' or f=='dstip'):
-                if(IPv4Network(v) != IPv4Network(other.map[f])):
-                    if(not IPv4Network(other.map[f]) in IPv4Network(v)):
-                        return False
+                if not _ip_within(other.map[f], v):
+                    return False
             elif v != other.map[f]:
                 return False
         return True
@@ -333,6 +662,9 @@ class identity(Filter):
         """
         return {pkt}
 
+    def compile_eval(self):
+        return lambda pkt, queries=None: {pkt}
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -354,6 +686,9 @@ class identity(Filter):
     def __repr__(self):
         return "identity"
 
+    def __reduce__(self):
+        return 'identity'
+
 passthrough = identity   # Imperative alias
 true = identity          # Logic alias
 all_packets = identity   # Matching alias
@@ -372,6 +707,9 @@ class drop(Filter):
         """
         return set()
 
+    def compile_eval(self):
+        return lambda pkt, queries=None: set()
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -392,6 +730,9 @@ class drop(Filter):
     def __repr__(self):
         return "drop"
 
+    def __reduce__(self):
+        return 'drop'
+
 none = drop
 false = drop             # Logic alias
 no_packets = drop        # Matching alias
@@ -404,17 +745,22 @@ class modify(Policy):
     :param *args: field assignments in argument format
     :param **kwargs: field assignments in keyword-argument format
     """
-    ### init : List (String * FieldVal) -> List KeywordArg -> unit
-    def __init__(self, *args, **kwargs):
+    ### new : List (String * FieldVal) -> List KeywordArg -> modify
+    def __new__(cls, *args, **kwargs):
         if len(args) == 0 and len(kwargs) == 0:
             raise TypeError
-        self.map = dict(*args, **kwargs)
-        self.has_virtual_headers = not \
+        return _intern(cls, util.frozendict(dict(*args, **kwargs)))
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self.map),))
+
+    @property
+    def has_virtual_headers(self):
+        return not \
             reduce(lambda acc, f:
                    acc and (f in compilable_headers),
                    self.map.keys(),
                    True)
-        super(modify,self).__init__()
 
     def eval(self, pkt):
         """
@@ -426,6 +772,12 @@ class modify(Policy):
         """
         return {pkt.modifymany(self.map)}
 
+    def compile_eval(self):
+        if _overrides_eval(self, modify):
+            return _eval_fn(self)
+        m = self.map
+        return lambda pkt, queries=None: {pkt.modifymany(m)}
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -442,8 +794,12 @@ class modify(Policy):
         return "modify: %s" % ' '.join(map(str,self.map.items()))
 
     def __eq__(self, other):
-        return ( isinstance(other, modify)
-           and (self.map == other.map) )
+        return ( self is other
+            or ( isinstance(other, modify)
+           and (self.map == other.map) ) )
+
+    def __hash__(self):
+        return hash(self.map)
 
 class sum_modify(Policy):
     """
@@ -508,6 +864,9 @@ class Controller(Policy):
 
     def __repr__(self):
         return "Controller"
+
+    def __reduce__(self):
+        return 'Controller'
     
 
 # FIXME: Srinivas =).
@@ -538,6 +897,19 @@ class Query(Filter):
 
     def dry_eval(self, pkt):
         return set()
+
+    def track_eval(self, pkt, dry=False):
+        if dry:
+            return (self.dry_eval(pkt), {self})
+        else:
+            return (self.eval(pkt), {self})
+
+    def compile_eval(self):
+        def eval_fn(pkt, queries=None):
+            if queries is not None:
+                queries.add(self)
+            return self.eval(pkt)
+        return eval_fn
         
     ### register_callback : (Packet -> X) -> unit
     def register_callback(self, fn):
@@ -746,12 +1118,33 @@ class CombinatorPolicy(Policy):
         self.policies = list(policies)
         super(CombinatorPolicy,self).__init__()
 
+    def compile_key(self):
+        try:
+            dynamic = self._dynamic_policies
+        except AttributeError:
+            dynamic = self._dynamic_policies = \
+                [p for p in self.policies if p.compile_key() is not None]
+        if not dynamic:
+            return None
+        return tuple(p.compile_key() for p in dynamic)
+
+    def __reduce__(self):
+        return (self.__class__, (self.policies,))
+
     def __repr__(self):
         return "%s:\n%s" % (self.name(),util.repr_plus(self.policies))
 
     def __eq__(self, other):
-        return ( self.__class__ == other.__class__
-           and   self.policies == other.policies )
+        return ( self is other
+            or ( self.__class__ == other.__class__
+           and   self.policies == other.policies ) )
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash((self.__class__, tuple(self.policies)))
+            return self._hash
 
 
 class negate(CombinatorPolicy,Filter):
@@ -774,6 +1167,27 @@ class negate(CombinatorPolicy,Filter):
         else:
             return {pkt}
 
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, negate):
+            return super(negate,self).track_eval(pkt, dry)
+        output, queries = self.policies[0].track_eval(pkt, dry)
+        if output:
+            return (set(), queries)
+        else:
+            return ({pkt}, queries)
+
+    def compile_eval(self):
+        if _overrides_eval(self, negate):
+            return _eval_fn(self)
+        inner_eval = self.policies[0].compile_eval()
+        def eval_fn(pkt, queries=None):
+            if inner_eval(pkt, queries):
+                return set()
+            else:
+                return {pkt}
+        return eval_fn
+
+    @_memoize_compile
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -793,9 +1207,80 @@ class negate(CombinatorPolicy,Filter):
         return classifier
 
 
+def _exact_value(value):
+    """
+    Whether a match pattern only matches header values equal to it, with
+    equal values hashing alike, so that it can serve as a dictionary key.
+    """
+    return isinstance(value, (int, long, basestring, IPAddr, EthAddr))
+
+
+def _leading_match(policy):
+    """
+    The match a packet must pass before policy does anything at all with
+    it, or None if there is no such match.
+    """
+    while True:
+        if isinstance(policy, match):
+            if _overrides_eval(policy, match):
+                return None
+            return policy
+        elif isinstance(policy, sequential):
+            if _overrides_eval(policy, sequential):
+                return None
+            policy = policy.policies[0]
+        elif ( isinstance(policy, DerivedPolicy) and
+               not isinstance(policy, DynamicPolicy) ):
+            if _overrides_eval(policy, DerivedPolicy):
+                return None
+            policy = policy.policy
+        else:
+            return None
+
+
+def _dispatch_index(policies):
+    """
+    Index policies on the header field that most of them start by
+    matching exactly.
+
+    :param policies: the policies to be indexed
+    :type policies: list Policy
+    :returns: None if fewer than two policies match on any one field,
+        otherwise the field, a dict from values of that field to the
+        policies matching the value, and the list of all other policies
+    :rtype: (string, dict from values to list Policy, list Policy)
+    """
+    exact_maps = []
+    counts = {}
+    for policy in policies:
+        exact_map = {}
+        leading_match = _leading_match(policy)
+        if leading_match is not None:
+            for (field, value) in leading_match.map.iteritems():
+                if _exact_value(value):
+                    exact_map[field] = value
+                    counts[field] = counts.get(field, 0) + 1
+        exact_maps.append(exact_map)
+    if not counts:
+        return None
+    field = max(counts, key=counts.get)
+    if counts[field] < 2:
+        return None
+    table = {}
+    rest = []
+    for (policy, exact_map) in zip(policies, exact_maps):
+        if field in exact_map:
+            table.setdefault(exact_map[field], []).append(policy)
+        else:
+            rest.append(policy)
+    return (field, table, rest)
+
+
 class parallel(CombinatorPolicy):
     """
     Combinator for several policies in parallel.
+    When several of the policies start with an exact match on the same
+    field, packets are dispatched only to the policies that can match them.
 
     :param policies: the policies to be combined.
     :type policies: list Policy
@@ -812,6 +1297,7 @@ class parallel(CombinatorPolicy):
     def __init__(self, policies=[]):
         if len(policies) == 0:
             raise TypeError
+        self._dispatch = None
         super(parallel, self).__init__(policies)
 
     def __add__(self, pol):
@@ -830,10 +1316,81 @@ class parallel(CombinatorPolicy):
         :rtype: set Packet
         """
         output = set()
-        for policy in self.policies:
+        for policy in self.candidate_policies(pkt):
             output |= policy.eval(pkt)
         return output
 
+    def dispatch_index(self):
+        """
+        The index used to find the policies that can match a packet,
+        built the first time it is needed.
+
+        :rtype: (string, dict from values to list Policy, list Policy)
+        """
+        if self._dispatch is None:
+            self._dispatch = (_dispatch_index(self.policies),)
+        return self._dispatch[0]
+
+    def candidate_policies(self, pkt):
+        """
+        The policies in self.policies that may produce output for pkt.
+
+        :param pkt: the packet on which to be evaluated
+        :type pkt: Packet
+        :rtype: list Policy
+        """
+        index = self.dispatch_index()
+        if index is None:
+            return self.policies
+        field, table, rest = index
+        try:
+            return table.get(pkt[field], []) + rest
+        except (KeyError, TypeError):
+            return rest
+
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, parallel):
+            return super(parallel,self).track_eval(pkt, dry)
+        output = set()
+        queries = set()
+        for policy in self.candidate_policies(pkt):
+            policy_output, policy_queries = policy.track_eval(pkt, dry)
+            output |= policy_output
+            queries |= policy_queries
+        return (output, queries)
+
+    def compile_eval(self):
+        if _overrides_eval(self, parallel):
+            return _eval_fn(self)
+        index = self.dispatch_index()
+        if index is not None:
+            field, table, rest = index
+            table_evals = { value : [policy.compile_eval() for policy in policies]
+                            for (value, policies) in table.iteritems() }
+            rest_evals = [policy.compile_eval() for policy in rest]
+            def eval_fn(pkt, queries=None):
+                output = set()
+                try:
+                    evals = table_evals.get(pkt[field], [])
+                except (KeyError, TypeError):
+                    evals = []
+                for policy_eval in evals:
+                    output |= policy_eval(pkt, queries)
+                for policy_eval in rest_evals:
+                    output |= policy_eval(pkt, queries)
+                return output
+            return eval_fn
+        evals = [policy.compile_eval() for policy in self.policies]
+        if len(evals) == 1:
+            return evals[0]
+        def eval_fn(pkt, queries=None):
+            output = set()
+            for policy_eval in evals:
+                output |= policy_eval(pkt, queries)
+            return output
+        return eval_fn
+
+    @_memoize_compile
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -842,8 +1399,8 @@ class parallel(CombinatorPolicy):
         """
         if len(self.policies) == 0:  # EMPTY PARALLEL IS A DROP
             return drop.compile()
-        classifiers = map(lambda p: p.compile(), self.policies)
-        return reduce(lambda acc, c: acc + c, classifiers)
+        classifiers = _compile_all(self.policies)
+        return _balanced_reduce(lambda acc, c: acc + c, classifiers)
 
 
 class union(parallel,Filter):
@@ -930,6 +1487,57 @@ class sequential(CombinatorPolicy):
             prev_output = output
         return output
 
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, sequential):
+            return super(sequential,self).track_eval(pkt, dry)
+        output = {pkt}
+        queries = set()
+        for policy in self.policies:
+            if policy is identity:
+                continue
+            if policy is drop:
+                return (set(), queries)
+            prev_output = output
+            output = set()
+            for p in prev_output:
+                policy_output, policy_queries = policy.track_eval(p, dry)
+                output |= policy_output
+                queries |= policy_queries
+            if not output:
+                break
+        return (output, queries)
+
+    def compile_eval(self):
+        if _overrides_eval(self, sequential):
+            return _eval_fn(self)
+        evals = []
+        drops = False
+        for policy in self.policies:
+            if policy is identity:
+                continue
+            if policy is drop:
+                drops = True
+                break
+            evals.append(policy.compile_eval())
+        if not drops and len(evals) == 0:
+            return identity.compile_eval()
+        if not drops and len(evals) == 1:
+            return evals[0]
+        def eval_fn(pkt, queries=None):
+            output = {pkt}
+            for policy_eval in evals:
+                prev_output = output
+                output = set()
+                for p in prev_output:
+                    output |= policy_eval(p, queries)
+                if not output:
+                    return output
+            if drops:
+                return set()
+            return output
+        return eval_fn
+
+    @_memoize_compile
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -937,7 +1545,7 @@ class sequential(CombinatorPolicy):
         :rtype: Classifier
         """
         assert(len(self.policies) > 0)
-        classifiers = map(lambda p: p.compile(),self.policies)
+        classifiers = _compile_all(self.policies)
         for c in classifiers:
             assert(c is not None)
         return reduce(lambda acc, c: acc >> c, classifiers)
@@ -974,6 +1582,108 @@ class intersection(sequential,Filter):
             raise TypeError
 
 
+class lpm(CombinatorPolicy):
+    """
+    Longest-prefix-match routing on an IP header field.  Each packet is
+    handled by the policy of the longest prefix containing its address,
+    or by the default policy if no prefix contains it.
+
+    :param routes: the policy for each prefix
+    :type routes: dict from IPPrefix to Policy, or list (IPPrefix, Policy)
+    :param field: the header field to route on
+    :type field: string
+    :param default: the policy for packets no prefix contains
+    :type default: Policy
+    """
+    def __init__(self, routes, field='dstip', default=drop):
+        if isinstance(routes, dict):
+            routes = routes.items()
+        self.field = field
+        self.default = default
+        self.trie = PrefixTrie(routes)
+        self.routes = self.trie.items()
+        super(lpm,self).__init__([policy for (prefix, policy) in self.routes] +
+                                 [default])
+
+    def __reduce__(self):
+        return (self.__class__, (self.routes, self.field, self.default))
+
+    def route(self, pkt):
+        """
+        The policy handling pkt.
+
+        :param pkt: the packet to be routed
+        :type pkt: Packet
+        :rtype: Policy
+        """
+        try:
+            return self.trie.longest_match(pkt[self.field], self.default)
+        except (KeyError, TypeError, ValueError):
+            return self.default
+
+    def eval(self, pkt):
+        """
+        evaluate this policy on a single packet
+
+        :param pkt: the packet on which to be evaluated
+        :type pkt: Packet
+        :rtype: set Packet
+        """
+        return self.route(pkt).eval(pkt)
+
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, lpm):
+            return super(lpm,self).track_eval(pkt, dry)
+        return self.route(pkt).track_eval(pkt, dry)
+
+    def compile_eval(self):
+        if _overrides_eval(self, lpm):
+            return _eval_fn(self)
+        field = self.field
+        trie = PrefixTrie([(prefix, policy.compile_eval())
+                           for (prefix, policy) in self.routes])
+        default_eval = self.default.compile_eval()
+        def eval_fn(pkt, queries=None):
+            try:
+                policy_eval = trie.longest_match(pkt[field], default_eval)
+            except (KeyError, TypeError, ValueError):
+                policy_eval = default_eval
+            return policy_eval(pkt, queries)
+        return eval_fn
+
+    @_memoize_compile
+    def compile(self):
+        """
+        Produce a Classifier for this policy, with the rules for longer
+        prefixes ahead of those for shorter ones.
+
+        :rtype: Classifier
+        """
+        rules = []
+        for (prefix, policy) in self.routes:
+            prefix_match = match({self.field : prefix})
+            for r in policy.compile().rules:
+                m = prefix_match.intersect(r.match)
+                if m != drop:
+                    rules.append(Rule(m, r.actions))
+        rules.extend(self.default.compile().rules)
+        return Classifier(rules)
+
+    def __eq__(self, other):
+        return ( self.__class__ == other.__class__
+           and   self.field == other.field
+           and   [(repr(p), pol) for (p, pol) in self.routes] ==
+                 [(repr(p), pol) for (p, pol) in other.routes]
+           and   self.default == other.default )
+
+    def __repr__(self):
+        return "lpm %s:\n%s\ndefault\n%s" % (
+            self.field,
+            '\n'.join("%s\n%s" % (prefix, util.repr_plus([policy]))
+                      for (prefix, policy) in self.routes),
+            util.repr_plus([self.default]))
+
+
 ################################################################################
 # Derived Policies                                                             #
 ################################################################################
@@ -999,6 +1709,21 @@ class DerivedPolicy(Policy):
         """
         return self.policy.eval(pkt)
 
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, DerivedPolicy):
+            # the output comes from the overriding eval, but the queries
+            # are still those the packet reaches in self.policy
+            output, _ = super(DerivedPolicy,self).track_eval(pkt, dry)
+            _, queries = self.policy.track_eval(pkt, dry=True)
+            return (output, queries)
+        return self.policy.track_eval(pkt, dry)
+
+    def compile_eval(self):
+        if _overrides_eval(self, DerivedPolicy):
+            return _eval_fn(self)
+        return self.policy.compile_eval()
+
+    @_memoize_compile
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -1007,12 +1732,19 @@ class DerivedPolicy(Policy):
         """
         return self.policy.compile()
 
+    def compile_key(self):
+        return self.policy.compile_key()
+
     def __repr__(self):
         return "[DerivedPolicy]\n%s" % repr(self.policy)
 
     def __eq__(self, other):
-        return ( self.__class__ == other.__class__
-           and ( self.policy == other.policy ) )
+        return ( self is other
+            or ( self.__class__ == other.__class__
+           and ( self.policy == other.policy ) ) )
+
+    def __hash__(self):
+        return hash((self.__class__, self.policy))
 
 
 class difference(DerivedPolicy,Filter):
@@ -1057,6 +1789,63 @@ class if_(DerivedPolicy):
         else:
             return self.f_branch.eval(pkt)
 
+    def track_eval(self, pkt, dry=False):
+        if _overrides_eval(self, if_):
+            return super(if_,self).track_eval(pkt, dry)
+        pred_output, queries = self.pred.track_eval(pkt, dry)
+        if pred_output:
+            output, branch_queries = self.t_branch.track_eval(pkt, dry)
+        else:
+            output, branch_queries = self.f_branch.track_eval(pkt, dry)
+        return (output, queries | branch_queries)
+
+    def compile_eval(self):
+        if _overrides_eval(self, if_):
+            return _eval_fn(self)
+        pred_eval = self.pred.compile_eval()
+        t_eval = self.t_branch.compile_eval()
+        f_eval = self.f_branch.compile_eval()
+        def eval_fn(pkt, queries=None):
+            if pred_eval(pkt, queries):
+                return t_eval(pkt, queries)
+            else:
+                return f_eval(pkt, queries)
+        return eval_fn
+
+    @_memoize_compile
+    def compile(self):
+        """
+        Produce a Classifier for this policy.  Each rule of the predicate's
+        classifier selects a region of packet space; the rules of the
+        branch taken in that region are restricted to it and emitted in
+        the predicate's priority order.  Since the branch classifiers are
+        total, every region is fully covered, so no negation of the
+        predicate or cross product of the branches is needed.
+
+        :rtype: Classifier
+        """
+        pred_classifier = self.pred.compile()
+        branches = {}
+        rules = []
+        for r in pred_classifier.rules:
+            if r.actions and all(a == identity for a in r.actions):
+                taken = True
+            elif not r.actions or r.actions == [drop]:
+                taken = False
+            else:
+                # not a filter classifier
+                return super(if_,self).compile()
+            if taken not in branches:
+                branch = self.t_branch if taken else self.f_branch
+                branches[taken] = branch.compile()
+            for br in branches[taken].rules:
+                restricted = r.match.intersect(br.match)
+                if restricted != drop:
+                    rules.append(Rule(restricted, br.actions))
+            if r.match == identity:
+                break
+        return Classifier(rules).optimize()
+
     def __repr__(self):
         return "if\n%s\nthen\n%s\nelse\n%s" % (util.repr_plus([self.pred]),
                                                util.repr_plus([self.t_branch]),
@@ -1094,6 +1883,46 @@ class xfwd(DerivedPolicy):
         return "xfwd %s" % self.outport
 
 
+class xflood(DerivedPolicy):
+    """
+    fwd out each of the specified ports, except the one the packet came in
+    on.  Equivalent to the parallel composition of xfwd on each port, but
+    compiles to one rule per port plus a default, rather than to the cross
+    product of the xfwds.
+
+    :param outports: the ports on which to forward.
+    :type outports: list int
+    """
+    def __init__(self, outports):
+        self.outports = sorted(outports)
+        super(xflood,self).__init__(parallel(map(xfwd, self.outports)))
+
+    def eval(self, pkt):
+        try:
+            inport = pkt['inport']
+        except KeyError:
+            inport = None
+        return {pkt.modify(outport=p) for p in self.outports if p != inport}
+
+    @_memoize_compile
+    def compile(self):
+        """
+        Produce a Classifier for this policy
+
+        :rtype: Classifier
+        """
+        def forward(outports):
+            return [modify(outport=p) for p in outports] or [drop]
+        rules = [Rule(match(inport=p),
+                      forward([q for q in self.outports if q != p]))
+                 for p in self.outports]
+        rules.append(Rule(identity, forward(self.outports)))
+        return Classifier(rules)
+
+    def __repr__(self):
+        return "xflood %s" % self.outports
+
+
 class link(DerivedPolicy):
     """
     Topology link from a source switch and outport to a dest switch and inport
@@ -1164,6 +1993,8 @@ class DynamicPolicy(DerivedPolicy):
     ### init : unit -> unit
     def __init__(self,policy=drop):
         self._policy = policy
+        self._compiled_eval = None
+        self._generation = 0
         self.notify = None
         super(DerivedPolicy,self).__init__()
 
@@ -1177,9 +2008,41 @@ class DynamicPolicy(DerivedPolicy):
         self.notify = None
 
     def changed(self):
+        self._generation += 1
         if self.notify:
             self.notify()
 
+    def compile_key(self):
+        return (self._generation, self._policy.compile_key())
+
+    @_memoize_compile
+    def compile(self):
+        """
+        Produce a Classifier for the normalized form of this policy
+
+        :rtype: Classifier
+        """
+        return normalize(self.policy).compile()
+
+    def compile_eval(self):
+        """
+        Produce a function equivalent to self.eval.  The function for the
+        current self.policy is compiled on first use and kept until
+        self.policy is reassigned.
+
+        :rtype: (Packet, set Query) -> set Packet
+        """
+        if _overrides_eval(self, DerivedPolicy):
+            return _eval_fn(self)
+        def eval_fn(pkt, queries=None):
+            policy = self._policy
+            compiled = self._compiled_eval
+            if compiled is None or compiled[0] is not policy:
+                compiled = (policy, normalize(policy).compile_eval())
+                self._compiled_eval = compiled
+            return compiled[1](pkt, queries)
+        return eval_fn
+
     @property
     def policy(self):
         return self._policy
@@ -1190,6 +2053,10 @@ class DynamicPolicy(DerivedPolicy):
         self._policy = policy
         self.changed()
 
+    def __hash__(self):
+        # self.policy changes, so dynamic policies hash by identity
+        return object.__hash__(self)
+
     def __repr__(self):
         return "[DynamicPolicy]\n%s" % repr(self.policy)
 
@@ -1225,7 +2092,7 @@ class flood(DynamicPolicy):
         if changed:
             self.policy = parallel([
                     match(switch=switch) >>
-                        parallel(map(xfwd,attrs['ports'].keys()))
+                        xflood(attrs['ports'].keys())
                     for switch,attrs in self.mst.nodes(data=True)])
 
     def __repr__(self):
@@ -1293,16 +2160,13 @@ def ast_fold(fun, acc, policy):
           isinstance(policy,parallel) or
           isinstance(policy,union) or
           isinstance(policy,sequential) or
-          isinstance(policy,intersection)):
+          isinstance(policy,intersection) or
+          isinstance(policy,lpm)):
         acc = fun(acc,policy)
         for sub_policy in policy.policies:
             acc = ast_fold(fun,acc,sub_policy)
         return acc
-    elif (isinstance(policy,difference) or
-          isinstance(policy,if_) or
-          isinstance(policy,fwd) or
-          isinstance(policy,xfwd) or
-          isinstance(policy,DynamicPolicy) or
+    elif (isinstance(policy,DerivedPolicy) or
           isinstance(policy,query.packets)):
         acc = fun(acc,policy)
         return ast_fold(fun,acc,policy.policy)
@@ -1325,35 +2189,167 @@ def add_query_sub_pols(acc, policy):
 
 def queries_in_eval(acc, policy):
     res,pkts = acc
-    if policy == drop:
-        acc = (res,set())
-    elif policy == identity:
+    output = set()
+    for pkt in pkts:
+        new_pkts,new_res = policy.track_eval(pkt, dry=True)
+        output |= new_pkts
+        res = res | new_res
+    return (res,output)
+
+
+###############################################################################
+# Normalization
+# a semantics-preserving rewrite of the policy tree, applied before compile
+# and eval.  Unlike simplify_tb, it never modifies its input.
+
+def _is_pure(policy):
+    """
+    Whether evaluating policy has no effect besides its output: no queries,
+    no dynamic policies that might later contain them, no Controller and
+    nothing the normalizer doesn't know.
+    """
+    if policy is identity or policy is drop:
+        return True
+    elif isinstance(policy, (match, modify)):
+        return True
+    elif type(policy) in (negate, parallel, union, sequential, intersection):
+        return all(_is_pure(p) for p in policy.policies)
+    elif type(policy) is if_:
+        return ( _is_pure(policy.pred) and _is_pure(policy.t_branch) and
+                 _is_pure(policy.f_branch) )
+    else:
+        return False
+
+
+def _collapsible(policy):
+    """
+    Whether policy is a DerivedPolicy that behaves exactly as its inner
+    policy, so that it can be replaced by it.
+    """
+    if not isinstance(policy, DerivedPolicy) or isinstance(policy, DynamicPolicy):
+        return False
+    for method in ('eval', 'track_eval', 'compile_eval', 'compile', 'compile_key'):
+        if ( getattr(type(policy), method).im_func is not
+             getattr(DerivedPolicy, method).im_func ):
+            return False
+    return True
+
+
+def _mergeable_modify(policy):
+    return ( isinstance(policy, modify) and
+             not any(v is None or isinstance(v, basestring)
+                     for v in policy.map.itervalues()) )
+
+
+def _normalize_sequential(policy, policies):
+    cls = type(policy)
+    flat = []
+    for p in policies:
+        if type(p) is cls or (cls is sequential and type(p) is intersection):
+            flat.extend(p.policies)
+        elif p is not identity:
+            flat.append(p)
+    merged = []
+    for p in flat:
+        if merged and isinstance(merged[-1], match) and isinstance(p, match):
+            try:
+                p = merged.pop().intersect(p)
+            except Exception:   # PATTERNS THAT CAN'T BE INTERSECTED
+                merged.append(p)
+                continue
+        elif ( merged and _mergeable_modify(merged[-1]) and
+               _mergeable_modify(p) ):
+            p = modify(merged.pop().map.update(p.map))
+        if p is drop:
+            # NOTHING AFTER A DROP IS EVALUATED
+            if all(_is_pure(q) for q in merged):
+                return drop
+            merged.append(p)
+            break
+        merged.append(p)
+    if len(merged) == 1:
+        return merged[0]
+    if _same_policies(merged, policy.policies):
+        return policy
+    return cls(merged)
+
+
+def _normalize_parallel(policy, policies):
+    cls = type(policy)
+    flat = []
+    for p in policies:
+        if type(p) is cls or (cls is parallel and type(p) is union):
+            flat.extend(p.policies)
+        elif p is not drop:
+            flat.append(p)
+    if ( cls is union and any(p is identity for p in flat) and
+         all(isinstance(p, Filter) and _is_pure(p) for p in flat) ):
+        return identity
+    if len(flat) == 1:
+        return flat[0]
+    if _same_policies(flat, policy.policies):
+        return policy
+    return cls(flat)
+
+
+def _same_policies(policies, others):
+    return ( len(policies) == len(others) and
+             all(p is q for (p, q) in zip(policies, others)) )
+
+
+def normalize(policy):
+    """
+    Produce a policy equivalent to policy with redundant structure removed:
+    nested sequential and parallel compositions are flattened, identity and
+    drop are folded away where that can't skip a query, adjacent matches
+    and adjacent modifies are merged, and derived policies are replaced by
+    the policies they wrap.  Dynamic policies and queries are kept as they
+    are.  The input is never modified, and the result is cached on it.
+
+    :param policy: the policy to be normalized
+    :type policy: Policy
+    :rtype: Policy
+    """
+    try:
+        return policy.__dict__['_normalized']
+    except (KeyError, AttributeError):
         pass
-    elif (isinstance(policy,match) or 
-          isinstance(policy,modify) or 
-          isinstance(policy,negate)):
-        new_pkts = set()
-        for pkt in pkts:
-            new_pkts |= policy.eval(pkt)
-        acc = (res,new_pkts)
-    elif isinstance(policy,Query):
-        acc = (res | {policy}, set())
-    elif isinstance(policy,DerivedPolicy):
-        acc = queries_in_eval(acc,policy.policy)
-    elif isinstance(policy,parallel):
-        parallel_res = set()
-        parallel_pkts = set()
-        for sub_pol in policy.policies:
-            new_res,new_pkts = queries_in_eval((res,pkts),sub_pol)
-            parallel_res |= new_res
-            parallel_pkts |= new_pkts
-        acc = (parallel_res,parallel_pkts)
-    elif isinstance(policy,sequential):
-        for sub_pol in policy.policies:
-            acc = queries_in_eval(acc,sub_pol)
-            if not acc[1]:
-                break
-    return acc
+    kind = type(policy)
+    if kind in (sequential, intersection):
+        children = [normalize(p) for p in policy.policies]
+        result = _normalize_sequential(policy, children)
+    elif kind in (parallel, union):
+        children = [normalize(p) for p in policy.policies]
+        result = _normalize_parallel(policy, children)
+    elif kind is negate:
+        inner = normalize(policy.policies[0])
+        if inner is identity:
+            result = drop
+        elif inner is drop:
+            result = identity
+        elif inner is policy.policies[0]:
+            result = policy
+        else:
+            result = negate([inner])
+    elif kind is if_:
+        pred = normalize(policy.pred)
+        t_branch = normalize(policy.t_branch)
+        f_branch = normalize(policy.f_branch)
+        if pred is identity:
+            result = t_branch
+        elif pred is drop:
+            result = f_branch
+        elif ( pred is policy.pred and t_branch is policy.t_branch and
+               f_branch is policy.f_branch ):
+            result = policy
+        else:
+            result = if_(pred, t_branch, f_branch)
+    elif _collapsible(policy):
+        result = normalize(policy.policy)
+    else:
+        return policy
+    policy._normalized = result
+    return result
 
 
 ###############################################################################
@@ -1403,6 +2399,191 @@ class Rule(object):
         return rv
 
 
+def _exact_key(value):
+    """
+    A dictionary key for value, equal for any two values that header
+    matches treat as equal.  Addresses are keyed by their type and integer
+    value, so that they never collide with a string of the same spelling
+    (a string pattern does not match an address).
+    """
+    if isinstance(value, IPAddr):
+        return (IPAddr, value.value)
+    if isinstance(value, EthAddr):
+        return (EthAddr, value.value)
+    return value
+
+
+class _RuleIndex(object):
+    """
+    Index of the positions of a list of rules on the header field that
+    the most of them match on, used to skip rules whose match obviously
+    conflicts with a given one.  IP fields are indexed by prefix, other
+    fields by exact value.
+
+    :param rules: the rules to be indexed
+    :type rules: list Rule
+    """
+    ip_fields = ('srcip', 'dstip')
+
+    def __init__(self, rules):
+        self.size = len(rules)
+        self.field = None
+        keys = []
+        counts = {}
+        distinct = {}
+        for rule in rules:
+            rule_keys = {}
+            if isinstance(rule.match, match):
+                for (field, value) in rule.match.map.iteritems():
+                    key = self._key(field, value)
+                    if key is not None:
+                        rule_keys[field] = key
+                        counts[field] = counts.get(field, 0) + 1
+                        distinct.setdefault(field, set()).add(repr(key))
+            keys.append(rule_keys)
+        if not counts:
+            return
+        self.field = max(counts,
+                         key=lambda f: (counts[f], len(distinct[f])))
+        if self.field in self.ip_fields:
+            self.table = PrefixTrie()
+        else:
+            self.table = {}
+        self.rest = []
+        for (i, rule_keys) in enumerate(keys):
+            if self.field in rule_keys:
+                key = rule_keys[self.field]
+                if key in self.table:
+                    self.table[key].append(i)
+                else:
+                    self.table[key] = [i]
+            else:
+                self.rest.append(i)
+
+    def _key(self, field, value):
+        if field in self.ip_fields:
+            if isinstance(value, (IPPrefix, IPAddr)):
+                return value
+            return None
+        if _exact_value(value):
+            return _exact_key(value)
+        return None
+
+    def candidates(self, m):
+        """
+        The positions, in order, of the rules whose matches may intersect m.
+
+        :param m: the match to be intersected
+        :type m: Filter
+        :rtype: list int
+        """
+        if self.field is None or not isinstance(m, match):
+            return xrange(self.size)
+        key = m.map.get(self.field)
+        key = None if key is None else self._key(self.field, key)
+        if key is None:
+            return xrange(self.size)
+        if self.field in self.ip_fields:
+            found = [i for positions in self.table.overlapping(key)
+                     for i in positions]
+        else:
+            found = list(self.table.get(key, []))
+        found.extend(self.rest)
+        found.sort()
+        return found
+
+
+class _CoverIndex(object):
+    """
+    Index of a growing list of rules, used to tell whether any of them
+    covers a given match without comparing against each one.  Rules are
+    grouped by the fields they match on, then by their exact values, then
+    by the prefix of their first IP field.
+    """
+    ip_fields = _RuleIndex.ip_fields
+
+    def __init__(self):
+        self.rules = []
+        self.groups = {}      # (exact fields, ip fields) -> exact values -> bucket
+        self.unindexed = []
+
+    def _split(self, m):
+        """
+        Split match m into its exact fields, their values and its IP
+        fields, or return None if some value cannot be indexed.
+        """
+        if not isinstance(m, match):
+            return None
+        exact = []
+        ip = []
+        for (field, value) in m.map.iteritems():
+            if field in self.ip_fields:
+                if not isinstance(value, (IPPrefix, IPAddr)):
+                    return None
+                ip.append(field)
+            elif _exact_value(value):
+                exact.append(field)
+            else:
+                return None
+        exact.sort()
+        ip.sort()
+        return (tuple(exact),
+                tuple(_exact_key(m.map[f]) for f in exact),
+                tuple(ip))
+
+    def add(self, rule):
+        self.rules.append(rule)
+        split = self._split(rule.match)
+        if split is None:
+            self.unindexed.append(rule)
+            return
+        exact, values, ip = split
+        buckets = self.groups.setdefault((exact, ip), {})
+        if not ip:
+            buckets.setdefault(values, []).append(rule)
+            return
+        trie = buckets.get(values)
+        if trie is None:
+            trie = buckets[values] = PrefixTrie()
+        prefix = rule.match.map[ip[0]]
+        if prefix in trie:
+            trie[prefix].append(rule)
+        else:
+            trie[prefix] = [rule]
+
+    def covers(self, m):
+        """
+        Whether the match of some rule in the index covers m.
+
+        :param m: the match to be covered
+        :type m: Filter
+        :rtype: bool
+        """
+        split = self._split(m)
+        if split is None:
+            return any(r.match.covers(m) for r in self.rules)
+        if any(r.match.covers(m) for r in self.unindexed):
+            return True
+        fields = m.map
+        for ((exact, ip), buckets) in self.groups.iteritems():
+            if not all(f in fields for f in exact):
+                continue
+            if not all(f in fields for f in ip):
+                continue
+            bucket = buckets.get(tuple(_exact_key(fields[f]) for f in exact))
+            if bucket is None:
+                continue
+            if not ip:
+                if any(r.match.covers(m) for r in bucket):
+                    return True
+                continue
+            for rules in bucket.containing(fields[ip[0]]):
+                for r in rules:
+                    if r.match.covers(m):
+                        return True
+        return False
+
+
 class Classifier(object):
     """
     A classifier contains a list of rules, where the order of the list implies
@@ -1443,9 +2624,11 @@ class Classifier(object):
         if c2 is None:
             return None
         c = Classifier([])
+        index = _RuleIndex(c2.rules)
         # TODO (cole): make classifiers iterable
         for r1 in c1.rules:
-            for r2 in c2.rules:
+            for i in index.candidates(r1.match):
+                r2 = c2.rules[i]
                 intersection = r1.match.intersect(r2.match)
                 if intersection != drop:
                     # TODO (josh) logic for detecting when sets of actions can't be combined
@@ -1510,19 +2693,16 @@ class Classifier(object):
             for a2 in as2:
                 while isinstance(a2, DerivedPolicy):
                     a2 = a2.policy
-                new_a1 = modify(**a1.map.copy())
                 if a2 == drop:
                     new_actions.append(drop)
                 elif a2 == Controller or isinstance(a2, CountBucket): 
                     new_actions.append(a2)
                 elif a2 == identity:
-                    new_actions.append(new_a1)
+                    new_actions.append(a1)
                 elif isinstance(a2, modify):
-                    new_a1.map.update(a2.map)
-                    new_actions.append(new_a1)
+                    new_actions.append(modify(a1.map.update(a2.map)))
                 elif isinstance(a2, fwd):
-                    new_a1.map['outport'] = a2.outport
-                    new_actions.append(new_a1)
+                    new_actions.append(modify(a1.map.update(outport=a2.outport)))
                 else:
                     raise TypeError
             return new_actions
@@ -1564,9 +2744,9 @@ class Classifier(object):
 
     def _sequence_rule_classifier(self, r, c):
         c2 = self._sequence_actions_classifier(r.actions, c)
-        for rule in c2.rules:
-            rule.match = rule.match.intersect(r.match)
-        c2.rules = [r2 for r2 in c2.rules if r2.match != drop]
+        rules = [Rule(rule.match.intersect(r.match), rule.actions)
+                 for rule in c2.rules]
+        c2 = Classifier([r2 for r2 in rules if r2.match != drop])
         return c2.optimize()
 
     def __rshift__(self, c2):
@@ -1593,14 +2773,11 @@ class Classifier(object):
 
     def remove_shadowed_cover_single(self):
         # Eliminate every rule completely covered by some higher priority rule
-        opt_c = Classifier([])
+        kept = _CoverIndex()
         for r in self.rules:
-            if not reduce(lambda acc, new_r: acc or
-                          new_r.match.covers(r.match),
-                          opt_c.rules,
-                          False):
-                opt_c.rules.append(r)
-        return opt_c
+            if not kept.covers(r.match):
+                kept.add(r)
+        return Classifier(kept.rules)
 
     def eval(self, in_pkt):
         """
@@ -1614,6 +2791,197 @@ class Classifier(object):
                 return pkts
         raise TypeError('Classifier is not total.')
 
+    def _switch_rules(self):
+        """
+        Split the rules into those matching on a single switch, by switch,
+        and the others.  Each switch-specific rule comes with the number of
+        other rules before it, so a switch's slice depends only on the
+        other rules and the switch's own.
+        """
+        general = []
+        specific = {}
+        for rule in self.rules:
+            m = rule.match
+            if isinstance(m, match) and 'switch' in m.map:
+                specific.setdefault(m.map['switch'], []).append(
+                    (len(general), rule))
+            else:
+                general.append(rule)
+        return (general, specific)
+
+    def switch_slices(self, switches, previous=None, previous_slices=None):
+        """
+        Project the classifier onto each of switches.  A switch's slice
+        holds, in order, the rules that can match packets at that switch,
+        each restricted to the switch; rules after one matching every
+        packet at the switch are left out.
+
+        Given the slices of a previous classifier, the slices of switches
+        whose rules are the same in both are reused rather than recomputed:
+        if no rule that isn't specific to a switch changed, only the
+        switches named by changed rules are projected anew.  Otherwise,
+        every rule that isn't specific to a switch is intersected with
+        every switch.
+
+        :param switches: the switches to project onto
+        :type switches: list int
+        :param previous: a classifier previously projected
+        :type previous: Classifier
+        :param previous_slices: the slices of previous
+        :type previous_slices: dict from int to Classifier
+        :rtype: dict from int to Classifier
+        """
+        slices = {}
+        todo = list(switches)
+        if previous is not None:
+            (general, specific) = self._switch_rules()
+            (old_general, old_specific) = previous._switch_rules()
+            if general == old_general:
+                todo = []
+                for s in switches:
+                    if (s in previous_slices and
+                        specific.get(s) == old_specific.get(s)):
+                        slices[s] = previous_slices[s]
+                    else:
+                        todo.append(s)
+        at = dict((s, match(switch=s)) for s in todo)
+        rules_at = dict((s, []) for s in todo)
+        open_slices = set(todo)
+        for rule in self.rules:
+            if not open_slices:
+                break
+            m = rule.match
+            if isinstance(m, match) and 'switch' in m.map:
+                s = m.map['switch']
+                if s in open_slices:
+                    rules_at[s].append(rule)
+                    if m == at[s]:
+                        open_slices.discard(s)
+                continue
+            for s in list(open_slices):
+                restricted = m.intersect(at[s])
+                if restricted == drop:
+                    continue
+                rules_at[s].append(Rule(restricted, rule.actions))
+                if restricted == at[s]:
+                    open_slices.discard(s)
+        for (s, rules) in rules_at.iteritems():
+            slices[s] = Classifier(rules)
+        return slices
+
+    def build_index(self):
+        """
+        Build a lookup structure evaluating packets like self.eval, but
+        without scanning the rules one by one.  The index reflects the
+        rules at the time it is built.
+
+        :rtype: ClassifierIndex
+        """
+        return ClassifierIndex(self)
+
+
+class ClassifierIndex(object):
+    """
+    Tuple-space lookup structure for a Classifier.  Rules are grouped by
+    the fields they match on (and the prefix lengths of their IP fields).
+    Each group is a dict from field values to the highest-priority rule
+    with those values, so a packet costs one lookup per group rather
+    than one match per rule.  Rules whose matches can't be keyed are
+    checked in order, as Classifier.eval does.
+
+    :param classifier: the classifier to be indexed
+    :type classifier: Classifier
+    """
+    ip_fields = _RuleIndex.ip_fields
+
+    def __init__(self, classifier):
+        self.rules = list(classifier.rules)
+        self.groups = {}    # (exact fields, ip fields and lengths) -> key -> position
+        self.unindexed = []
+        for (i, rule) in enumerate(self.rules):
+            if rule.match == drop:
+                continue
+            entry = self._rule_entry(rule.match)
+            if entry is None:
+                self.unindexed.append(i)
+                continue
+            signature, key = entry
+            self.groups.setdefault(signature, {}).setdefault(key, i)
+        self.group_list = self.groups.items()
+
+    def _rule_entry(self, m):
+        if m == identity:
+            return (((), ()), ())
+        if not isinstance(m, match):
+            return None
+        exact = []
+        ip = []
+        for (field, value) in m.map.iteritems():
+            if field in self.ip_fields:
+                if isinstance(value, (IPPrefix, IPAddr)):
+                    (addr, masklen) = value.network()
+                    ip.append((field, masklen, addr))
+                else:
+                    return None
+            elif _exact_value(value):
+                exact.append(field)
+            else:
+                return None
+        exact.sort()
+        ip.sort()
+        signature = (tuple(exact),
+                     tuple((field, masklen) for (field, masklen, addr) in ip))
+        key = (tuple(_exact_key(m.map[f]) for f in exact) +
+               tuple(addr & _netmask(masklen) for (field, masklen, addr) in ip))
+        return (signature, key)
+
+    def lookup(self, pkt):
+        """
+        The position of the first rule matching pkt, or None.
+
+        :param pkt: the packet to be looked up
+        :type pkt: Packet
+        :rtype: int
+        """
+        ip_values = {}
+        for field in self.ip_fields:
+            try:
+                value = pkt[field]
+            except KeyError:
+                continue
+            if not isinstance(value, IPAddr):   # MATCHED BY STRING, SCAN RULES
+                for (i, rule) in enumerate(self.rules):
+                    if rule.match.eval(pkt):
+                        return i
+                return None
+            ip_values[field] = value.value
+        best = None
+        for ((exact, ip), table) in self.group_list:
+            try:
+                key = tuple(_exact_key(pkt[f]) for f in exact)
+                for (field, masklen) in ip:
+                    key += (ip_values[field] & _netmask(masklen),)
+                i = table.get(key)
+            except (KeyError, TypeError):
+                continue
+            if i is not None and (best is None or i < best):
+                best = i
+        for i in self.unindexed:
+            if best is not None and i > best:
+                break
+            if self.rules[i].match.eval(pkt):
+                return i
+        return best
+
+    def eval(self, in_pkt):
+        """
+        Evaluate as Classifier.eval would on the indexed classifier.
+        """
+        i = self.lookup(in_pkt)
+        if i is None:
+            raise TypeError('Classifier is not total.')
+        return self.rules[i].eval(in_pkt)
+
 
 ###############################################################################
 # Simplifies a given policy for traceback.
@@ -1710,8 +3078,7 @@ def simplify_seq_pair(pair):
             for key in dup_keys:
                 if pair[0].map[key] != pair[1].map[key]: # TODO: deal with IP prefixing
                     return drop
-            pair[0].map = pair[0].map.update(pair[1].map)
-            return pair[0]
+            return match(pair[0].map.update(pair[1].map))
         else:
             return sequential(pair)
 
@@ -1719,8 +3086,7 @@ def simplify_seq_pair(pair):
         
         # Two modifys in a row; always merge.
         if isinstance(pair[1], modify):
-            pair[0].map = pair[0].map.update(pair[1].map)
-            return pair[0]
+            return modify(pair[0].map.update(pair[1].map))
         
         # modify >> match. Simplifies to drop if any fields match with different values.
         elif isinstance(pair[1], match):
@@ -1737,17 +3103,17 @@ def simplify_seq_pair(pair):
             if len(match_keys) is 0:
                 return sequential(pair)
             # Merge match fields into modify fields and simplify!
-            mcopy = match(pair[1].map) # Copy match first, since otherwise negations get messed up...
+            remaining = dict(pair[1].map) # Matches are shared, so work on a copy of the fields
             for key in match_keys:
-                pair[0].restrict(key, match({key:mcopy.map[key]}))
+                pair[0].restrict(key, match({key:remaining[key]}))
                 # If there are any resultant drops, the whole sequential policy is a drop.
                 if pair[0].fields[key] is drop:
                     return drop
-                mcopy.map = mcopy.map.remove([key]) # Remove the entry from the match
+                del remaining[key] # Remove the entry from the match
             simplified = sum_to_modify(pair[0])
             # if anything left in the match, append it to the simplified sum_modify
-            if len(mcopy.map) > 0:
-                simplified = simplified >> mcopy
+            if len(remaining) > 0:
+                simplified = simplified >> match(remaining)
             return simplified
         
         # Sum modify followed by modify. Kill any fields in sum_modify shadowed by modify.
@@ -1772,7 +3138,7 @@ def simplify_seq_pair(pair):
 # remainder of the sum_modify. We pull out any modifies whose field policies eval
 # to a "few" possibilities (e.g. match with no negates after simplification)
 def sum_to_modify(sm):
-    mod = None
+    mod_fields = {}
     for key in sm.fields.copy():
         policy = sm.fields[key]
 
@@ -1780,16 +3146,14 @@ def sum_to_modify(sm):
             continue
         # Simplify if match
         elif isinstance(policy, match):
-            if mod:
-                mod.map.update(policy.map)
-            else:
-                mod = modify(policy.map)
+            mod_fields.update(policy.map)
             sm.fields.pop(key)
         # Should never see drop.
         elif policy is drop:
             raise RuntimeError("Something went wrong; sum_modify should never have a drop for a field.")
         # TODO handle parallel, other cases
-    if mod:
+    if mod_fields:
+        mod = modify(mod_fields)
         if len(sm.fields) is 0:
             return mod
         else:
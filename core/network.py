@@ -30,6 +30,7 @@
 
 import socket
 import struct
+import threading
 from bitarray import bitarray
 import networkx as nx
 
@@ -47,6 +48,31 @@ IP_TYPE  = 0x800
 # Fixed width stuff
 ################################################################################
 
+def _netmask(masklen):
+    return (0xffffffff << (32 - masklen)) & 0xffffffff
+
+
+ADDRESS_CACHE_SIZE = 1 << 16
+_address_cache = {}
+
+def _cached_address(cls, key, value):
+    """
+    The address of class cls with the given int value, remembered under
+    key (its wire or string form) so that parsing key again is a lookup.
+    The cache is emptied whenever it grows past ADDRESS_CACHE_SIZE.
+    """
+    try:
+        addr = _address_cache[(cls, value)]
+    except KeyError:
+        addr = object.__new__(cls)
+        addr.value = value
+        if len(_address_cache) >= ADDRESS_CACHE_SIZE:
+            _address_cache.clear()
+        _address_cache[(cls, value)] = addr
+    _address_cache[(cls, key)] = addr
+    return addr
+
+
 class IPPrefix(object):
     def __init__(self, pattern):
         self.masklen = 32
@@ -56,12 +82,23 @@ class IPPrefix(object):
             self.masklen = int(parts[1])
         else:
             raise TypeError
-        self.prefix = self.pattern.to_bits()[:self.masklen]
+        self.value = self.pattern.value & _netmask(self.masklen)
+
+    @property
+    def prefix(self):
+        return self.pattern.to_bits()[:self.masklen]
+
+    def network(self):
+        """The (address as int, mask length) pair of this prefix"""
+        return (self.value, self.masklen)
 
     def __eq__(self, other):
         """Match by checking prefix equality"""
         if isinstance(other,IPAddr):
-            return self.prefix == other.to_bits()[:self.masklen]
+            return self.value == other.value & _netmask(self.masklen)
+        elif isinstance(other,IPPrefix):
+            return ( self.value == other.value and
+                     self.masklen == other.masklen )
         else:
             return False
 
@@ -69,43 +106,57 @@ class IPPrefix(object):
         return not (self == other)
 
     def __hash__(self):
-        return hash((self.pattern,self.masklen))
+        return hash((self.value,self.masklen))
 
     def __repr__(self):
         return "%s/%d" % (repr(self.pattern),self.masklen)
 
 
 class IPAddr(object):
-    def __init__(self, ip):
+    __slots__ = ['value']
+
+    def __new__(cls, ip):
 
         # already a IP object
         if isinstance(ip, IPAddr):
-            self.bits = ip.bits
+            if type(ip) is cls:
+                return ip
+            return _cached_address(cls, ip.value, ip.value)
 
         # otherwise will be in byte or string encoding
+        assert isinstance(ip, basestring)
+        try:
+            return _address_cache[(cls, ip)]
+        except KeyError:
+            pass
+
+        # byte encoding
+        if len(ip) == 4:
+            value = struct.unpack('!I', ip)[0]
+
+        # string encoding
         else:
-            assert isinstance(ip, basestring)
-            
-            b = bitarray()
+            value = struct.unpack('!I', socket.inet_aton(ip))[0]
 
-            # byte encoding
-            if len(ip) == 4:
-                b.frombytes(ip)
+        return _cached_address(cls, ip, value)
 
-            # string encoding
-            else:
-                b.frombytes(socket.inet_aton(ip))
+    def __reduce__(self):
+        return (self.__class__, (self.to_bytes(),))
 
-            self.bits = b
+    def network(self):
+        """The (address as int, mask length) pair of this address"""
+        return (self.value, 32)
 
     def to_bits(self):
-        return self.bits
+        b = bitarray()
+        b.frombytes(self.to_bytes())
+        return b
 
     def to01(self):
-        return self.bits.to01()
+        return self.to_bits().to01()
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack('!I', self.value)
 
     def fromRaw(self):
         return self.to_bytes()
@@ -114,61 +165,228 @@ class IPAddr(object):
         return socket.inet_ntoa(self.to_bytes())
 
     def __hash__(self):
-        return hash(self.to_bytes())    
+        return hash(self.value)
 
     def __eq__(self,other):
+        if isinstance(other, IPAddr):
+            return self.value == other.value
         return repr(self) == repr(other)
 
     def __ne__(self, other):
         return not (self == other)
 
 class IP(IPAddr):
-    pass
+    __slots__ = []
+
+
+def _prefix_key(prefix):
+    """
+    Convert an IP prefix or address to an (address, mask length) pair,
+    with the address as a 32-bit integer.
+    """
+    if isinstance(prefix, (IPPrefix, IPAddr)):
+        return prefix.network()
+    elif isinstance(prefix, basestring):
+        parts = prefix.split("/")
+        addr = IPAddr(parts[0])
+        masklen = int(parts[1]) if len(parts) == 2 else 32
+    else:
+        raise TypeError
+    if not 0 <= masklen <= 32:
+        raise ValueError
+    return (addr.value & _netmask(masklen), masklen)
+
+
+class PrefixTrie(object):
+    """
+    A binary trie mapping IP prefixes to values.  Lookups walk at most one
+    node per address bit, however many prefixes are stored.
+    """
+    # node layout: [zero child, one child, has value, value]
+    def __init__(self, items=[]):
+        self._root = [None, None, False, None]
+        self._len = 0
+        for (prefix, value) in items:
+            self[prefix] = value
+
+    def _find(self, prefix, create=False):
+        addr, masklen = _prefix_key(prefix)
+        node = self._root
+        for i in xrange(masklen):
+            bit = (addr >> (31 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, False, None]
+            node = node[bit]
+        return node
+
+    def __setitem__(self, prefix, value):
+        node = self._find(prefix, create=True)
+        if not node[2]:
+            self._len += 1
+        node[2] = True
+        node[3] = value
+
+    def __getitem__(self, prefix):
+        node = self._find(prefix)
+        if node is None or not node[2]:
+            raise KeyError(prefix)
+        return node[3]
+
+    def __contains__(self, prefix):
+        node = self._find(prefix)
+        return node is not None and node[2]
+
+    def __len__(self):
+        return self._len
+
+    def longest_match(self, addr, default=None):
+        """
+        The value stored under the longest prefix containing addr.
+
+        :param addr: the address to look up
+        :type addr: IPAddr or string
+        :param default: returned when no stored prefix contains addr
+        """
+        addr = _prefix_key(addr)[0]
+        node = self._root
+        value = node[3] if node[2] else default
+        for i in xrange(32):
+            node = node[(addr >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[2]:
+                value = node[3]
+        return value
+
+    def containing(self, prefix):
+        """
+        The values stored under prefixes that contain prefix (including
+        prefix itself), shortest prefixes first.
+
+        :param prefix: the prefix to look up
+        :type prefix: IPPrefix, IPAddr or string
+        :rtype: list value
+        """
+        addr, masklen = _prefix_key(prefix)
+        found = []
+        node = self._root
+        for i in xrange(masklen):
+            if node[2]:
+                found.append(node[3])
+            node = node[(addr >> (31 - i)) & 1]
+            if node is None:
+                return found
+        if node[2]:
+            found.append(node[3])
+        return found
+
+    def overlapping(self, prefix):
+        """
+        The values stored under prefixes that contain prefix or are
+        contained in it.
+
+        :param prefix: the prefix to compare against
+        :type prefix: IPPrefix, IPAddr or string
+        :rtype: list value
+        """
+        addr, masklen = _prefix_key(prefix)
+        found = []
+        node = self._root
+        for i in xrange(masklen):
+            if node[2]:
+                found.append(node[3])
+            node = node[(addr >> (31 - i)) & 1]
+            if node is None:
+                return found
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node[2]:
+                found.append(node[3])
+            for child in node[:2]:
+                if child is not None:
+                    stack.append(child)
+        return found
+
+    def items(self):
+        """
+        The stored (prefix, value) pairs, longest prefixes first.
+
+        :rtype: list (IPPrefix, value)
+        """
+        found = []
+        stack = [(self._root, 0, 0)]
+        while stack:
+            node, addr, masklen = stack.pop()
+            if node[2]:
+                found.append((addr, masklen, node[3]))
+            for bit in (0, 1):
+                if node[bit] is not None:
+                    stack.append((node[bit],
+                                  addr | (bit << (31 - masklen)),
+                                  masklen + 1))
+        found.sort(key=lambda (addr, masklen, value): (-masklen, addr))
+        return [(IPPrefix("%s/%d" % (socket.inet_ntoa(struct.pack('!I', addr)),
+                                     masklen)), value)
+                for (addr, masklen, value) in found]
 
             
 class EthAddr(object):
-    def __init__(self, mac):
+    __slots__ = ['value']
+
+    def __new__(cls, mac):
 
         # already a MAC object
         if isinstance(mac, EthAddr):
-            self.bits = mac.bits
+            if type(mac) is cls:
+                return mac
+            return _cached_address(cls, mac.value, mac.value)
 
         # otherwise will be in byte or string encoding
+        assert isinstance(mac, basestring)
+        try:
+            return _address_cache[(cls, mac)]
+        except KeyError:
+            pass
+
+        # byte encoding
+        if len(mac) == 6:
+            value = struct.unpack("!Q", "\x00\x00" + mac)[0]
+
+        # string encoding
         else:
-            assert isinstance(mac, basestring)
-            
-            b = bitarray()
-
-            # byte encoding
-            if len(mac) == 6:
-                b.frombytes(mac)
-
-            # string encoding
-            else:
-                import re
-                m = re.match(r"""(?xi)
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})[:-]+
-                             ([0-9a-f]{1,2})
-                             """, mac)
-                if not m:
-                    raise ValueError
-                else:
-                    b.frombytes(struct.pack("!BBBBBB", *(int(s, 16) for s in m.groups())))
+            import re
+            m = re.match(r"""(?xi)
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})[:-]+
+                         ([0-9a-f]{1,2})
+                         """, mac)
+            if not m:
+                raise ValueError
+            value = 0
+            for part in m.groups():
+                value = (value << 8) | int(part, 16)
+
+        return _cached_address(cls, mac, value)
+
+    def __reduce__(self):
+        return (self.__class__, (self.to_bytes(),))
 
-            self.bits = b
-        
     def to_bits(self):
-        return self.bits
+        b = bitarray()
+        b.frombytes(self.to_bytes())
+        return b
 
     def to01(self):
-        return self.bits.to01()
+        return self.to_bits().to01()
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack("!Q", self.value)[2:]
 
     def __repr__(self):
         parts = struct.unpack("!BBBBBB", self.to_bytes())
@@ -176,16 +394,18 @@ class EthAddr(object):
         return mac
 
     def __hash__(self):
-        return hash(self.to_bytes())
+        return hash(self.value)
 
     def __eq__(self,other):
+        if isinstance(other, EthAddr):
+            return self.value == other.value
         return repr(self) == repr(other)
 
     def __ne__(self, other):
         return not (self == other)
 
 class MAC(EthAddr):
-    pass
+    __slots__ = []
 
         
 ################################################################################
@@ -193,19 +413,73 @@ class MAC(EthAddr):
 ################################################################################
 
 
+_field_names = []      # POSITION -> FIELD NAME
+_field_positions = {}  # FIELD NAME -> POSITION
+_field_lock = threading.Lock()
+_ABSENT = object()
+
+def _field_position(field):
+    """
+    The position of field in every packet's value tuple, assigned the
+    first time the field is seen.
+    """
+    try:
+        return _field_positions[field]
+    except KeyError:
+        with _field_lock:
+            if field not in _field_positions:
+                _field_names.append(field)
+                _field_positions[field] = len(_field_names) - 1
+            return _field_positions[field]
+
+
+def _trimmed(values):
+    """A tuple of values without any trailing absent fields."""
+    end = len(values)
+    while end and values[end - 1] is _ABSENT:
+        end -= 1
+    return tuple(values[:end])
+
+
 class Packet(object):
-    __slots__ = ["header"]
+    """
+    A packet's header fields, stored as a tuple indexed by a registry of
+    field names shared by all packets, so that modified copies only copy
+    references and equal packets have equal tuples.
+    """
+    __slots__ = ["_values", "_hash"]
     
     def __init__(self, state={}):
-        self.header = util.frozendict(state)
+        values = []
+        for (field, value) in state.items():
+            i = _field_position(field)
+            if i >= len(values):
+                values.extend([_ABSENT] * (i + 1 - len(values)))
+            values[i] = value
+        self._values = _trimmed(values)
+        self._hash = None
+
+    @classmethod
+    def _from_values(cls, values):
+        pkt = cls.__new__(cls)
+        pkt._values = values
+        pkt._hash = None
+        return pkt
+
+    @property
+    def header(self):
+        return util.frozendict((_field_names[i], v)
+                               for (i, v) in enumerate(self._values)
+                               if v is not _ABSENT)
 
     def available_fields(self):
-        return self.header.keys()
+        return [_field_names[i] for (i, v) in enumerate(self._values)
+                if v is not _ABSENT]
 
     def __eq__(self, other):
         return ( id(self) == id(other)
                  or ( isinstance(other, self.__class__)
-                      and self.header == other.header ) )
+                      and self._values == other._values ) )
 
     def __ne__(self, other):
         return not (self == other)
@@ -214,25 +488,50 @@ class Packet(object):
         return self.modifymany(kwargs)
               
     def modifymany(self, d):
-        add = {}
+        old = self._values
+        values = list(old)
         delete = []
         for k, v in d.items():
             if v is None:
                 delete.append(k)
-            else:
-                add[k] = v
-                ################################ BEGIN EDIT
-                # Added by hlzhang@ to support copying of values between keys
-                if v in self.available_fields():
-                    add[k] = self.header[v]
-                ################################ END EDIT
-        return Packet(self.header.update(add).remove(delete))
+                continue
+            ################################ BEGIN EDIT
+            # Added by hlzhang@ to support copying of values between keys
+            try:
+                j = _field_positions.get(v)
+            except TypeError:
+                j = None
+            if j is not None and j < len(old) and old[j] is not _ABSENT:
+                v = old[j]
+            ################################ END EDIT
+            i = _field_position(k)
+            if i >= len(values):
+                values.extend([_ABSENT] * (i + 1 - len(values)))
+            values[i] = v
+        for k in delete:
+            i = _field_positions.get(k)
+            if i is None or i >= len(values) or values[i] is _ABSENT:
+                raise KeyError(k)
+            values[i] = _ABSENT
+        return Packet._from_values(_trimmed(values))
 
     def __getitem__(self, item):
-        return self.header[item]
+        i = _field_positions[item]
+        try:
+            v = self._values[i]
+        except IndexError:
+            raise KeyError(item)
+        if v is _ABSENT:
+            raise KeyError(item)
+        return v
 
     def __hash__(self):
-        return hash(self.header)
+        if self._hash is None:
+            self._hash = hash(self._values)
+        return self._hash
+
+    def __reduce__(self):
+        return (Packet, (dict(self.header.items()),))
         
     def __repr__(self):
         import hashlib
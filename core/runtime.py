@@ -31,11 +31,134 @@
 import pyretic.core.util as util
 from pyretic.core.language import *
 from pyretic.core.network import *
-from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
-import logging, sys, time
+from multiprocessing import RLock, Lock, Value, Queue, Condition
+import logging, sys, threading, time
 from datetime import datetime
 
 TABLE_MISS_PRIORITY = 0
+MAX_PRIORITY = 60000
+PRIORITY_GAP = 16
+
+
+def _decreasing_run(values):
+    """
+    Positions of a longest strictly decreasing subsequence of values,
+    skipping None entries.
+    """
+    tails = []      # tails[k]: position ending the best run of length k+1
+    previous = {}
+    for (i, v) in enumerate(values):
+        if v is None:
+            continue
+        (lo, hi) = (0, len(tails))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[tails[mid]] > v:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[i] = tails[lo-1] if lo > 0 else None
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+    run = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        run.append(i)
+        i = previous[i]
+    return run[::-1]
+
+
+def allocate_priorities(keys, old_priorities, top=MAX_PRIORITY,
+                        bottom=TABLE_MISS_PRIORITY, gap=PRIORITY_GAP):
+    """
+    Assign decreasing priorities, at most top and above bottom, to a
+    switch's rules.  As many rules as the order allows keep the priority
+    their key had before, new rules are spaced by up to gap in the room
+    between them, and all rules are renumbered only when there is no room
+    left, so that a small change to the rules changes few priorities.
+
+    :param keys: the keys (e.g. matches) of the rules, highest priority first
+    :type keys: list
+    :param old_priorities: the previous priority of each key
+    :type old_priorities: dict
+    :returns: the priority of each rule
+    :rtype: list int
+    :raises ValueError: if there are more rules than priorities
+    """
+    def fill(priorities, start, end, hi, lo):
+        # spread the rules in [start, end) strictly between hi and lo
+        count = end - start
+        if count == 0:
+            return True
+        step = min(gap, (hi - lo) // (count + 1))
+        if step < 1:
+            return False
+        for i in xrange(count):
+            priorities[start + i] = hi - step * (i + 1)
+        return True
+
+    olds = []
+    for key in keys:
+        p = old_priorities.get(key)
+        olds.append(p if p is not None and bottom < p <= top else None)
+    priorities = [None] * len(keys)
+    for i in _decreasing_run(olds):
+        priorities[i] = olds[i]
+
+    start = 0
+    hi = top + 1
+    for i in xrange(len(keys) + 1):
+        if i < len(keys) and priorities[i] is None:
+            continue
+        lo = priorities[i] if i < len(keys) else bottom
+        if not fill(priorities, start, i, hi, lo):
+            # out of room: renumber everything
+            priorities = [None] * len(keys)
+            if not fill(priorities, 0, len(keys), top + 1, bottom):
+                raise ValueError('%d rules do not fit between priorities %d and %d'
+                                 % (len(keys), bottom, top))
+            return priorities
+        start = i + 1
+        hi = lo
+    return priorities
+
+
+def _hashable(item):
+    if isinstance(item, dict):
+        return frozenset((k, _hashable(v)) for (k, v) in item.items())
+    elif isinstance(item, (list, tuple)):
+        return tuple(map(_hashable, item))
+    else:
+        return item
+
+
+def group_switch_rules(rules):
+    """
+    Group rules that are the same except for the switch they are on.
+
+    :param rules: concrete rules, each a match dict on a switch followed
+        by the rest of the rule (e.g. priority and action list)
+    :type rules: list tuple
+    :returns: for each group, in the order the groups first appear, the
+        list of switches followed by the rule with no switch in its match
+    :rtype: list list
+    """
+    groups = []
+    positions = {}
+    for rule in rules:
+        pred = dict(rule[0])
+        switch = pred.pop('switch')
+        rest = list(rule[1:])
+        key = (_hashable(pred), _hashable(rest))
+        try:
+            groups[positions[key]][0].append(switch)
+        except KeyError:
+            positions[key] = len(groups)
+            groups.append([[switch], pred] + rest)
+    return groups
+
 
 class Runtime(object):
     """
@@ -52,13 +175,19 @@ class Runtime(object):
     :type mode: string
     :param verbosity: one of low, normal, high, please-make-it-stop
     :type verbosity: string
+    :param compile_processes: number of processes compiling independent
+        parts of the policy, or None to compile in this process only
+    :type compile_processes: int
     """
-    def __init__(self, backend, main, kwargs, mode='interpreted', verbosity='normal'):
+    def __init__(self, backend, main, kwargs, mode='interpreted', verbosity='normal',
+                 compile_processes=None):
         self.verbosity = self.verbosity_numeric(verbosity)
+        set_compile_processes(compile_processes)
         self.log = logging.getLogger('%s.Runtime' % __name__)
         self.network = ConcreteNetwork(self)
         self.prev_network = self.network.copy()
         self.policy = main(**kwargs)
+        self.policy_eval = normalize(self.policy).compile_eval()
         self.mode = mode
         self.backend = backend
         self.backend.runtime = self
@@ -73,9 +202,14 @@ class Runtime(object):
         self.in_update_network = False
         self.global_outstanding_queries_lock = Lock()
         self.global_outstanding_queries = {}
-        self.manager = Manager()
-        self.old_rules_lock = Lock()
-        self.old_rules = self.manager.list()
+        self.installed_rules = {}   # switch -> (match items, priority) -> rule
+        self.installed_classifier = None
+        self.installed_slices = {}
+        self.install_cond = threading.Condition()
+        self.install_jobs = []
+        self.install_thread = threading.Thread(target=self.install_loop)
+        self.install_thread.daemon = True
+        self.install_thread.start()
         self.update_rules_lock = Lock()
         self.update_buckets_lock = Lock()
 
@@ -101,11 +235,10 @@ class Runtime(object):
         with self.policy_lock:
             pyretic_pkt = self.concrete2pyretic(concrete_pkt)
 
-            # find the queries, if any in the policy, that will be evaluated
-            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),self.policy)
-
-            # evaluate the policy
-            output = self.policy.eval(pyretic_pkt)
+            # evaluate the policy, collecting the queries, if any in the
+            # policy, that were evaluated
+            queries = set()
+            output = self.policy_eval(pyretic_pkt, queries)
 
             # apply the queries whose buckets have received new packets
             for q in queries:
@@ -136,7 +269,7 @@ class Runtime(object):
             self.update_dynamic_sub_pols()
             classifier = None
             if self.mode == 'proactive0' or self.mode == 'proactive1':
-                classifier = self.policy.compile()
+                classifier = normalize(self.policy).compile()
 
         self.update_switches(classifier)
           
@@ -156,7 +289,7 @@ class Runtime(object):
                     self.update_dynamic_sub_pols()
                     classifier = None
                     if self.mode == 'proactive0' or self.mode == 'proactive1':
-                        classifier = self.policy.compile()
+                        classifier = normalize(self.policy).compile()
 
                     self.update_switches(classifier)
 
@@ -474,32 +607,6 @@ class Runtime(object):
                                           rule.actions))
                               for rule in classifier.rules)
 
-        def switchify(classifier,switches):
-            """
-            Specialize a classifer to a set of switches.  Any rule that doesn't 
-            specify a match on switch is turned into a set of rules matching on
-            each switch respectively.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :param switches: the network switches
-            :type switches: set int
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            new_rules = list()
-            for rule in classifier.rules:
-                if isinstance(rule.match, match) and 'switch' in rule.match.map:
-                    if not rule.match.map['switch'] in switches:
-                        continue
-                    new_rules.append(rule)
-                else:
-                    for s in switches:
-                        new_rules.append(Rule(
-                                rule.match.intersect(match(switch=s)),
-                                rule.actions))
-            return Classifier(new_rules)
-
         def concretize(classifier):
             """
             Convert policies into dictionaries.
@@ -557,6 +664,15 @@ class Runtime(object):
                 return new_actions
 
             specialized_rules = []
+            seen_matches = set()
+            def add_rule(rule):
+                # skip rules exactly shadowed by a higher priority one, e.g.
+                # specializations of an xflood default rule
+                key = frozenset(rule.match.items())
+                if not key in seen_matches:
+                    seen_matches.add(key)
+                    specialized_rules.append(rule)
+
             for rule in classifier.rules:
                 phys_actions = filter(lambda a: (a['outport'] != OFPP_CONTROLLER 
                                                  and a['outport'] != OFPP_IN_PORT),
@@ -569,66 +685,81 @@ class Runtime(object):
                         new_match = copy.deepcopy(rule.match)
                         new_match['inport'] = outport
                         new_actions = specialize_actions(rule.actions,outport)
-                        specialized_rules.append(Rule(new_match,new_actions))
+                        add_rule(Rule(new_match,new_actions))
                     # And a default rule for any inport outside the set of outports_used
-                    specialized_rules.append(rule)
+                    add_rule(rule)
                 else:
                     if rule.match['inport'] in outports_used:
                         # Modify the set of actions
                         new_actions = specialize_actions(rule.actions,rule.match['inport'])
-                        specialized_rules.append(Rule(rule.match,new_actions))
+                        add_rule(Rule(rule.match,new_actions))
                     else:
                         # Leave as before
-                        specialized_rules.append(rule)
+                        add_rule(rule)
 
             return Classifier(specialized_rules)
 
-        def prioritize(classifier):
+        def match_key(concrete_pred):
+            return frozenset(concrete_pred.items())
+
+        def prioritize(classifier, old_priorities):
             """
-            Add priorities to classifier rules based on their ordering.
+            Add priorities to a switch's classifier rules based on their
+            ordering, keeping the priorities in old_priorities where
+            possible (see allocate_priorities).
             
             :param classifier: the input classifer
             :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param old_priorities: the current priority of each match key
+            :type old_priorities: dict
+            :returns: the prioritized rules
+            :rtype: list (match dict, priority, action list)
             """
-            priority = {}
-            tuple_rules = list()
-            for rule in classifier.rules:
-                s = rule.match['switch']
-                try:
-                    priority[s] -= 1
-                except KeyError:
-                    priority[s] = 60000
-                tuple_rules.append((rule.match,priority[s],rule.actions))
-            return tuple_rules
+            keys = [match_key(rule.match) for rule in classifier.rules]
+            priorities = allocate_priorities(keys, old_priorities)
+            return [(rule.match,priority,rule.actions)
+                    for (rule,priority) in zip(classifier.rules,priorities)]
 
         ### UPDATE LOGIC
 
-        def nuclear_install(classifier):
+        def switch_rules(classifier, old_priorities={}):
             """
-            Delete all rules currently installed on switches and then
-            install input classifier from scratch.
-            
-            :param classifier: the input classifer
+            Convert a switch's slice of the classifier to prioritized
+            OpenFlow rules.
+
+            :param classifier: the slice of a single switch
             :type classifier: Classifier
+            :param old_priorities: the priorities currently installed for
+                each match, as keyed by match_key
+            :type old_priorities: dict
+            :returns: the rules for the switch
+            :rtype: list (match dict, priority, action list)
             """
-            switch_attrs_tuples = self.network.topology.nodes(data=True)
-            switch_to_attrs = { k : v for (k,v) in switch_attrs_tuples }
-            switches = switch_to_attrs.keys()
-            classifier = switchify(classifier,switches)
             classifier = concretize(classifier)
             classifier = OF_inportize(classifier)
-            new_rules = prioritize(classifier)
+            return prioritize(classifier, old_priorities)
+
+        def nuclear_install(slices):
+            """
+            Delete all rules currently installed on switches and then
+            install input classifier from scratch.
+            
+            :param slices: the classifier's slice for each switch
+            :type slices: dict from int to Classifier
+            """
+            switches = slices.keys()
 
             for s in switches:
                 self.send_barrier(s)
                 self.send_clear(s)
                 self.send_barrier(s)
-                self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
+            self.install_rules([({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}])
+                                for s in switches])
 
-            for rule in new_rules:
-                self.install_rule(rule)
+            new_rules = []
+            for s in switches:
+                new_rules += switch_rules(slices[s])
+            self.install_rules(new_rules)
                 
             for s in switches:
                 self.send_barrier(s)
@@ -637,76 +768,79 @@ class Runtime(object):
 
         ### INCREMENTAL UPDATE LOGIC
 
-        def find_same_rule(target, rule_list):
-            if rule_list is None:
-                return None
-            for rule in rule_list:
-                if target[0] == rule[0] and target[1] == rule[1]:
-                    return rule
-            return None
+        def rule_key(rule):
+            (concrete_pred, priority, action_list) = rule
+            return (match_key(concrete_pred), priority)
 
-        def install_diff_rules(classifier):
+        def install_diff_rules(slices, switches):
             """
             Calculate and install the difference between the input classifier
             and the current switch tables.
             
-            :param classifier: the input classifer
-            :type classifier: Classifier
+            :param slices: the classifier's slice for each switch whose
+                slice changed
+            :type slices: dict from int to Classifier
+            :param switches: all the network switches
+            :type switches: list int
             """
-            with self.old_rules_lock:
-                old_rules = self.old_rules
-                switch_attrs_tuples = self.network.topology.nodes(data=True)
-                switch_to_attrs = { k : v for (k,v) in switch_attrs_tuples }
-                switches = switch_to_attrs.keys()
-                classifier = switchify(classifier,switches)
-                classifier = concretize(classifier)
-                classifier = OF_inportize(classifier)
-                new_rules = prioritize(classifier)
+            for s in self.installed_rules.keys():
+                if not s in switches:
+                    del self.installed_rules[s]
+
+            to_add = list()
+            to_modify = list()
+            to_delete = list()
+            for s in slices:
+                old_rules = self.installed_rules.get(s, {})
+                old_priorities = dict(old_rules.keys())
+                new_rules = switch_rules(slices[s], old_priorities)
+                installed = {}
+                for rule in new_rules:
+                    installed[rule_key(rule)] = rule
 
                 # calculate diff
-                to_add = list()
-                to_delete = list()
-                to_modify = list()
-                for old in old_rules:
-                    new = find_same_rule(old, new_rules)
-                    if new is None:
-                        to_delete.append(old)
-                    else:
-                        if old[2] != new[2]:
-                            to_modify.append(new)
-    
-                for new in new_rules:
-                    old = find_same_rule(new, old_rules)
-                    if old is None:
-                        to_add.append(new)
-    
-                # install diff
-                if not to_add is None:
-                    for rule in to_add:
-                        self.install_rule(rule)
-                for rule in to_delete:
-                    if rule[0]['switch'] in switches:
-                        self.delete_rule((rule[0], rule[1]))
-                for rule in to_modify:
-                    self.delete_rule((rule[0], rule[1]))
-                    self.install_rule(rule)
-    
-                # update old_rule
-                del old_rules[0:len(old_rules)]
                 for rule in new_rules:
-                    old_rules.append(rule)
-
-                for s in switches:
-                    self.send_barrier(s)
+                    old = old_rules.get(rule_key(rule))
+                    if old is None:
+                        to_add.append(rule)
+                    elif old[2] != rule[2]:
+                        to_modify.append(rule)
+                for (key, rule) in old_rules.items():
+                    if not key in installed:
+                        to_delete.append((rule[0], rule[1]))
+
+                self.installed_rules[s] = installed
+
+            # install diff
+            self.install_rules(to_add)
+            self.modify_rules(to_modify)
+            self.delete_rules(to_delete)
+            for s in slices:
+                self.send_barrier(s)
 
-        ### PROCESS THAT DOES INSTALL
+        ### JOB RUN BY THE INSTALL WORKER
 
-        def f(classifier):
+        def f():
+            # Only switches whose slice changed need their rules recomputed
+            # and diffed, unless all tables are rebuilt anyway; slices whose
+            # rules are unchanged since the last install are reused as is
+            switches = self.network.topology.nodes()
+            if self.mode == 'proactive1':
+                slices = classifier.switch_slices(switches,
+                                                  self.installed_classifier,
+                                                  self.installed_slices)
+            else:
+                slices = classifier.switch_slices(switches)
             with self.switch_lock:
                 if self.mode == 'proactive0':
-                    nuclear_install(classifier)
+                    nuclear_install(slices)
                 elif self.mode == 'proactive1':
-                    install_diff_rules(classifier)
+                    changed = { s : c for (s,c) in slices.items()
+                                if not s in self.installed_slices
+                                or self.installed_slices[s] != c }
+                    install_diff_rules(changed, switches)
+                    self.installed_classifier = classifier
+                    self.installed_slices = slices
 
         # Process classifier to an openflow-compatible format before
         # sending out rule installs
@@ -719,9 +853,39 @@ class Runtime(object):
         bookkeep_buckets(classifier)
         classifier = remove_buckets(classifier)
 
-        p = Process(target=f,args=(classifier,))
-        p.daemon = True
-        p.start()
+        self.queue_install('install', f)
+
+    def queue_install(self, kind, job):
+        """
+        Hand a job over to the install worker, which runs jobs one at a
+        time in the order they were queued.  A job supersedes any pending
+        job of the same kind, so that only the latest classifier gets
+        installed when installs are requested faster than they complete.
+
+        :param kind: the kind of job, e.g. 'install' or 'clear'
+        :type kind: string
+        :param job: the function to be run
+        :type job: function
+        """
+        with self.install_cond:
+            self.install_jobs = [(k, j) for (k, j) in self.install_jobs
+                                 if k != kind]
+            self.install_jobs.append((kind, job))
+            self.install_cond.notify()
+
+    def install_loop(self):
+        """
+        Body of the install worker thread.
+        """
+        while True:
+            with self.install_cond:
+                while not self.install_jobs:
+                    self.install_cond.wait()
+                (kind, job) = self.install_jobs.pop(0)
+            try:
+                job()
+            except Exception:
+                self.log.exception("%s job failed" % kind)
 
 
 ###################
@@ -821,6 +985,39 @@ class Runtime(object):
                 (str(priority) + " " + repr(concrete_pred) + " "+ repr(action_list))))
         self.backend.send_install(concrete_pred,priority,action_list)
 
+    def install_rules(self,rules):
+        """
+        Install many rules at once, with rules identical but for their
+        switch sent as one rule for a list of switches.
+
+        :param rules: the rules to install
+        :type rules: list (match dict, priority, action list)
+        """
+        if rules:
+            self.log.debug('|%s|\n\t%s %d openflow rules\n' %
+                           (str(datetime.now()), "sending", len(rules)))
+            self.backend.send_install_many(group_switch_rules(rules))
+
+    def modify_rules(self,rules):
+        """
+        Modify the actions of many installed rules at once.
+
+        :param rules: the rules with their new actions
+        :type rules: list (match dict, priority, action list)
+        """
+        if rules:
+            self.backend.send_modify_many(group_switch_rules(rules))
+
+    def delete_rules(self,rules):
+        """
+        Delete many installed rules at once.
+
+        :param rules: the rules to delete
+        :type rules: list (match dict, priority)
+        """
+        if rules:
+            self.backend.send_delete_many(group_switch_rules(rules))
+
     def delete_rule(self,(concrete_pred,priority)):
         self.backend.send_delete(concrete_pred,priority)
 
@@ -833,14 +1030,16 @@ class Runtime(object):
     def clear_all(self):
         def f():
             switches = self.network.topology.nodes()
-            for s in switches:
-                self.send_barrier(s)
-                self.send_clear(s)
-                self.send_barrier(s)
-                self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
-        p = Process(target=f)
-        p.daemon = True
-        p.start()
+            with self.switch_lock:
+                for s in switches:
+                    self.send_barrier(s)
+                    self.send_clear(s)
+                    self.send_barrier(s)
+                    self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
+                self.installed_classifier = None
+                self.installed_slices = {}
+                self.installed_rules = {}
+        self.queue_install('clear', f)
 
     def request_flow_stats(self,switch):
         self.backend.send_flow_stats_request(switch)
@@ -945,8 +1144,6 @@ def extended_values_from(packet):
 # Concrete Network
 ################################################################################
 
-import threading 
-
 class ConcreteNetwork(Network):
     def __init__(self,runtime=None):
         super(ConcreteNetwork,self).__init__()
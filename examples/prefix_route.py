@@ -41,9 +41,9 @@ ipp1 = IPPrefix('10.0.0.0/31')
 ipp2 = IPPrefix('10.0.0.2/31')
 ipp3 = IPPrefix('10.0.0.4/31')
 
-l3route = ((match(dstip=ipp1) >> fwd(1)) +
-           (match(dstip=ipp2) >> fwd(2)) +
-           (match(dstip=ipp3) >> fwd(3)) )
+l3route = lpm({ ipp1 : fwd(1),
+                ipp2 : fwd(2),
+                ipp3 : fwd(3) })
 
 def main():
     return l3route
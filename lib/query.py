@@ -62,6 +62,22 @@ class LimitFilter(DynamicFilter):
             self.done.append(match(val))
             self.policy = ~union(self.done)
 
+    def forget(self,val):
+        """Stop counting the packets in the grouping with header values val,
+        so that its next limit packets are matched again.
+
+        :param val: the value of each group_by field
+        :type val: dict
+        """
+        pred = match(val)
+        self.seen.pop(pred,None)
+        if pred in self.done:
+            self.done.remove(pred)
+            if self.done:
+                self.policy = ~union(self.done)
+            else:
+                self.policy = identity
+
     def __repr__(self):
         return "LimitFilter\n%s" % repr(self.policy)
 
@@ -39,13 +39,216 @@
 #           examine dumps, confirm that h2 does not see packets on second ping #
 ################################################################################
 
+from collections import OrderedDict
+import threading
+import time
+import weakref
+
 from pyretic.lib.corelib import *
 from pyretic.lib.std import *
 from pyretic.lib.query import *
 
+def _expire_periodically(table_ref):
+    """Body of a mac_table's expiry thread; returns once the table is gone."""
+    while True:
+        table = table_ref()
+        if table is None:
+            return
+        wait = table.next_expiry() - time.time()
+        del table
+        time.sleep(max(wait, 0.01))
+        table = table_ref()
+        if table is None:
+            return
+        table.expire()
+        del table
+
+
+class mac_table(DynamicPolicy):
+    """Forwarding table of learned MAC addresses.
+    Packets whose (switch, dstmac) has been learned are forwarded out the
+    learned port, all others are handed to the default policy.
+
+    :param default: the policy for packets with no table entry
+    :type default: Policy
+    :param timeout: seconds after which an entry expires, None for never
+    :type timeout: float
+    :param max_entries: the most entries kept, None for no bound
+    :type max_entries: int
+    :param on_remove: called with the keys of removed entries
+    :type on_remove: list (int, EthAddr) -> unit
+    """
+    def __init__(self, default=drop, timeout=None, max_entries=None,
+                 on_remove=None):
+        self.default = default
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.on_remove = on_remove
+        self.entries = OrderedDict()   # (switch,mac) -> (port,learned), OLDEST FIRST
+        self.entries_lock = threading.RLock()
+        self._policy_cache = None
+        self.expiry_thread = None
+        super(mac_table,self).__init__(default)
+
+    def attach(self, notify):
+        """Once the table is in use, expire entries in the background, so
+        that rules for expired entries get removed."""
+        super(mac_table,self).attach(notify)
+        if self.timeout is not None and self.expiry_thread is None:
+            self.expiry_thread = threading.Thread(target=_expire_periodically,
+                                                  args=(weakref.ref(self),))
+            self.expiry_thread.daemon = True
+            self.expiry_thread.start()
+
+    def live(self, learned, now):
+        return self.timeout is None or now - learned < self.timeout
+
+    def learn(self, switch, mac, port, now=None):
+        """Add or refresh the entry for mac on switch.
+        Returns the keys of the entries removed to make room or expired.
+
+        :rtype: list (int, EthAddr)
+        """
+        if now is None:
+            now = time.time()
+        with self.entries_lock:
+            key = (switch, mac)
+            self.entries.pop(key, None)
+            self.entries[key] = (port, now)
+            removed = self._remove_expired(now)
+            if self.max_entries is not None:
+                while len(self.entries) > self.max_entries:
+                    removed.append(self.entries.popitem(last=False)[0])
+        # CALLBACKS MAY TAKE RUNTIME LOCKS, SO RUN THEM WITHOUT entries_lock
+        self.removed(removed)
+        self.changed()
+        return removed
+
+    def expire(self, now=None, notify=True):
+        """Remove the entries older than the timeout, passing their keys
+        to on_remove.  Returns the keys of the removed entries.
+
+        :rtype: list (int, EthAddr)
+        """
+        if now is None:
+            now = time.time()
+        with self.entries_lock:
+            removed = self._remove_expired(now)
+        self.removed(removed)
+        if removed and notify:
+            self.changed()
+        return removed
+
+    def _remove_expired(self, now):
+        # CALLER HOLDS entries_lock
+        removed = []
+        if self.timeout is None:
+            return removed
+        while self.entries:
+            key, (port, learned) = next(self.entries.iteritems())
+            if self.live(learned, now):
+                break
+            del self.entries[key]
+            removed.append(key)
+        return removed
+
+    def removed(self, keys):
+        if keys and self.on_remove:
+            self.on_remove(keys)
+
+    def next_expiry(self):
+        """The time at which the oldest entry expires, or a timeout from now
+        if there is none."""
+        with self.entries_lock:
+            if self.entries:
+                port, learned = next(self.entries.itervalues())
+                return learned + self.timeout
+        return time.time() + self.timeout
+
+    def live_entries(self, now=None):
+        """The ((switch,mac),(port,learned)) pairs not yet expired, oldest first."""
+        if now is None:
+            now = time.time()
+        with self.entries_lock:
+            return [(key, value) for (key, value) in self.entries.iteritems()
+                    if self.live(value[1], now)]
+
+    def lookup(self, pkt, now=None):
+        """The learned port for pkt, or None if there is no live entry."""
+        try:
+            port, learned = self.entries[(pkt['switch'], pkt['dstmac'])]
+        except (KeyError, TypeError):
+            return None
+        if now is None:
+            now = time.time()
+        if not self.live(learned, now):
+            return None
+        return port
+
+    def eval(self, pkt):
+        port = self.lookup(pkt)
+        if port is None:
+            return self.default.eval(pkt)
+        return {pkt.modify(outport=port)}
+
+    def track_eval(self, pkt, dry=False):
+        port = self.lookup(pkt)
+        if port is None:
+            return self.default.track_eval(pkt, dry)
+        return ({pkt.modify(outport=port)}, set())
+
+    def compile_eval(self):
+        default_eval = self.default.compile_eval()
+        def eval_fn(pkt, queries=None):
+            port = self.lookup(pkt)
+            if port is None:
+                return default_eval(pkt, queries)
+            return {pkt.modify(outport=port)}
+        return eval_fn
+
+    def compile(self):
+        """One rule per live entry, followed by the default policy's rules."""
+        rules = [Rule(match(switch=switch,dstmac=mac),[modify(outport=port)])
+                 for ((switch,mac),(port,learned)) in self.live_entries()]
+        return Classifier(rules + self.default.compile().rules)
+
+    def changed(self):
+        self._policy_cache = None
+        super(mac_table,self).changed()
+
+    @property
+    def policy(self):
+        if self._policy_cache is None:
+            entries = self.live_entries()
+            if not entries:
+                self._policy_cache = self.default
+            else:
+                learned = [match(switch=switch,dstmac=mac)
+                           for ((switch,mac),value) in entries]
+                self._policy_cache = if_(
+                    union(learned),
+                    parallel([m >> fwd(port) for (m,(key,(port,t)))
+                              in zip(learned,entries)]),
+                    self.default)
+        return self._policy_cache
+
+    def __repr__(self):
+        return "mac_table\n%s" % '\n'.join(
+            "%s %s -> %s" % (switch,mac,port)
+            for ((switch,mac),(port,learned)) in self.entries.iteritems())
+
+
 class mac_learner(DynamicPolicy):
-    """Standard MAC-learning logic"""
-    def __init__(self):
+    """Standard MAC-learning logic
+
+    :param timeout: seconds after which a learned MAC is forgotten
+    :type timeout: float
+    :param max_entries: the most MACs remembered at once
+    :type max_entries: int
+    """
+    def __init__(self, timeout=None, max_entries=None):
+        self.timeout = timeout
+        self.max_entries = max_entries
         super(mac_learner,self).__init__()
         self.flood = flood()           # REUSE A SINGLE FLOOD INSTANCE
         self.set_initial_state()
@@ -53,7 +256,10 @@ class mac_learner(DynamicPolicy):
     def set_initial_state(self):
         self.query = packets(1,['srcmac','switch'])
         self.query.register_callback(self.learn_new_MAC)
-        self.forward = self.flood  # REUSE A SINGLE FLOOD INSTANCE
+        self.forward = mac_table(self.flood,  # REUSE A SINGLE FLOOD INSTANCE
+                                 self.timeout,
+                                 self.max_entries,
+                                 self.forget_MACs)
         self.update_policy()
 
     def set_network(self,network):
@@ -65,11 +271,12 @@ class mac_learner(DynamicPolicy):
 
     def learn_new_MAC(self,pkt):
         """Update forward policy based on newly seen (mac,port)"""
-        self.forward = if_(match(dstmac=pkt['srcmac'],
-                                switch=pkt['switch']),
-                          fwd(pkt['inport']),
-                          self.forward) 
-        self.update_policy()
+        self.forward.learn(pkt['switch'],pkt['srcmac'],pkt['inport'])
+
+    def forget_MACs(self,removed):
+        """Let the query see the MACs of removed table entries again"""
+        for (switch,mac) in removed:
+            self.query.limit_filter.forget({'srcmac' : mac, 'switch' : switch})
        
 
 def main():
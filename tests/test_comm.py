@@ -0,0 +1,177 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.backend.comm import *
+
+import pytest
+
+### Binary format ###
+
+def roundtrip(msg):
+    frame = encode_binary(msg)
+    assert frame_length(frame[:FRAME_HEADER_SIZE]) == len(frame) - FRAME_HEADER_SIZE
+    return decode_binary(frame[FRAME_HEADER_SIZE:])
+
+def test_binary_tags():
+    for (value, tag) in [(None, 'n'), (True, 't'), (False, 'f'), (-5, 'i'),
+                         (1 << 70, 'b'), (2.5, 'd'), ('ab', 's'), ([1], 'l'),
+                         ({'switch' : 1}, 'm')]:
+        assert encode_binary(value)[FRAME_HEADER_SIZE] == tag
+        assert roundtrip(value) == value
+    assert roundtrip([None, True, False, [], {}, '']) == \
+        [None, True, False, [], {}, '']
+
+def test_binary_bigints():
+    for value in [(1 << 63) - 1, -(1 << 63), 1 << 63, -(1 << 63) - 1,
+                  0xffffffffffffffffff]:
+        assert roundtrip(value) == value
+    assert roundtrip([1L << 64]) == [1L << 64]
+
+def test_binary_raw_bytes():
+    raw = 'a\nb\x00\xff' + TERM_CHAR + ''.join(map(chr, range(256)))
+    msg = ['packet', {'switch' : 1, 'raw' : raw, 'srcmac' : '\n\n\n\n\n\n'}]
+    assert roundtrip(msg) == msg
+    # what the JSON format gives for the same message
+    assert deserialize([serialize(msg)]) == msg
+
+def test_binary_dicts_like_json():
+    class Addr(object):
+        def __repr__(self):
+            return 'addr'
+    msg = ['install', {'dstip' : Addr(), 'switch' : 1L << 40, 'inport' : 2,
+                       'nested' : [1]}, 100]
+    assert roundtrip(msg) == deserialize([serialize(msg)])
+    assert roundtrip(msg)[1] == dict_to_ascii(msg[1])
+
+def test_binary_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        encode_binary([object()])
+    with pytest.raises(ValueError):
+        decode_binary('x')
+    with pytest.raises(ValueError):
+        decode_binary('nn')
+
+### Stream decoding ###
+
+def feed_all(decoder, chunks):
+    messages = []
+    for chunk in chunks:
+        messages += decoder.feed(chunk)
+    return messages
+
+def test_stream_split_everywhere():
+    msg = ['packet', {'switch' : 1, 'raw' : 'a\nb'}]
+    json_data = serialize(msg) + serialize(['barrier', 1])
+    binary_data = encode_binary(msg) + encode_binary(['barrier', 1])
+    for (prefix, data) in [('', json_data),
+                           (BINARY_HELLO + TERM_CHAR, binary_data)]:
+        for i in xrange(len(data) + 1):
+            decoder = StreamDecoder()
+            decoder.feed(prefix)
+            assert feed_all(decoder, [data[:i], data[i:]]) == \
+                [msg, ['barrier', 1]]
+            assert decoder.error is None
+        decoder = StreamDecoder()
+        assert feed_all(decoder, [prefix] + list(data)) == [msg, ['barrier', 1]]
+
+def test_stream_switch_to_binary_mid_chunk():
+    decoder = StreamDecoder()
+    data = (serialize(['switch', 'join', 1, 'BEGIN']) + BINARY_HELLO + TERM_CHAR +
+            encode_binary(['switch', 'part', 1]))
+    assert decoder.feed(data) == [['switch', 'join', 1, 'BEGIN'],
+                                  ['switch', 'part', 1]]
+    assert decoder.binary
+
+def test_stream_zero_length_frame():
+    decoder = StreamDecoder()
+    decoder.feed(BINARY_HELLO + TERM_CHAR)
+    data = '\x00\x00\x00\x00' + encode_binary(['barrier', 2])
+    assert decoder.feed(data) == [None, ['barrier', 2]]
+
+def test_stream_rejects_oversized_messages():
+    decoder = StreamDecoder(max_message_size=100)
+    assert decoder.feed(serialize(['barrier', 1]) + '[' * 200) == [['barrier', 1]]
+    assert isinstance(decoder.error, ValueError)
+    assert decoder.feed(serialize(['barrier', 1])) == []
+    decoder = StreamDecoder(max_message_size=100)
+    data = (BINARY_HELLO + TERM_CHAR + encode_binary(['barrier', 1]) +
+            encode_binary(['x' * 200]))
+    assert decoder.feed(data) == [['barrier', 1]]
+    assert isinstance(decoder.error, ValueError)
+
+def test_stream_keeps_messages_before_bad_frame():
+    decoder = StreamDecoder()
+    data = (BINARY_HELLO + TERM_CHAR + encode_binary(['barrier', 1]) +
+            '\x00\x00\x00\x02?!')
+    assert decoder.feed(data) == [['barrier', 1]]
+    assert isinstance(decoder.error, ValueError)
+
+def test_stream_batch_hello():
+    decoder = StreamDecoder()
+    data = (BATCH_HELLO + TERM_CHAR + BINARY_HELLO + TERM_CHAR +
+            encode_binary(['barrier', 1]))
+    assert decoder.feed(data) == [['barrier', 1]]
+    assert decoder.batch and decoder.binary
+    assert not StreamDecoder().batch
+
+### Batch fallback ###
+
+from pyretic.backend.backend import Backend
+
+class RecordingBackend(Backend):
+    def __init__(self, batch):
+        class Channel(object):
+            pass
+        self.backend_channel = Channel()
+        self.backend_channel.batch = batch
+        self.sent = []
+
+    def send_to_OF_client(self, msg):
+        self.sent.append(msg)
+
+def test_batches_when_announced():
+    backend = RecordingBackend(batch=True)
+    rules = [[[1, 2], {'inport' : 1}, 100, []]]
+    backend.send_install_many(rules)
+    backend.send_modify_many(rules)
+    backend.send_delete_many([[[1, 2], {'inport' : 1}, 100]])
+    assert backend.sent == [['install_many', rules], ['modify_many', rules],
+                            ['delete_many', [[[1, 2], {'inport' : 1}, 100]]]]
+
+def test_rule_messages_when_not_announced():
+    backend = RecordingBackend(batch=False)
+    backend.send_install_many([[[1, 2], {'inport' : 1}, 100, []]])
+    assert backend.sent == [['install', {'switch' : 1, 'inport' : 1}, 100, []],
+                            ['install', {'switch' : 2, 'inport' : 1}, 100, []]]
+    backend.sent = []
+    backend.send_modify_many([[[1], {'inport' : 1}, 100, ['a']]])
+    assert backend.sent == [['delete', {'switch' : 1, 'inport' : 1}, 100],
+                            ['install', {'switch' : 1, 'inport' : 1}, 100, ['a']]]
+    backend.sent = []
+    backend.send_delete_many([[[3], {}, 7]])
+    assert backend.sent == [['delete', {'switch' : 3}, 7]]
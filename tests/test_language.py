@@ -489,3 +489,488 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+# Closure compilation
+
+def test_compile_eval_matches_eval():
+    ip1 = IPAddr('10.0.0.1')
+    ip2 = IPAddr('10.0.0.2')
+    pol = (if_(match(srcip=ip1), modify(srcip=ip2)) >>
+           ((match(inport=1) >> fwd(2)) + (~match(inport=1) >> fwd(1))))
+    for inport in [1, 2]:
+        pkt = Packet({'srcip':ip1, 'inport':inport})
+        assert pol.compile_eval()(pkt) == pol.eval(pkt)
+
+def test_compile_eval_sequential_drop():
+    pol = match(inport=1) >> drop >> fwd(2)
+    assert pol.compile_eval()(Packet({'inport':1})) == set()
+
+def test_compile_eval_dynamic_policy_change():
+    dyn = DynamicPolicy(fwd(1))
+    pol_eval = (match(inport=1) >> dyn).compile_eval()
+    pkt = Packet({'inport':1})
+    assert pol_eval(pkt) == {pkt.modify(outport=1)}
+    dyn.policy = fwd(2)
+    assert pol_eval(pkt) == {pkt.modify(outport=2)}
+
+# Query tracking
+
+def test_track_eval_collects_queries():
+    fb = FwdBucket()
+    pol = (match(inport=1) >> fb) + fwd(2)
+    pkt = Packet({'inport':1})
+    output, queries = pol.track_eval(pkt)
+    assert output == {pkt.modify(outport=2)}
+    assert queries == {fb}
+    assert fb.bucket == {pkt}
+    output, queries = pol.track_eval(Packet({'inport':2}))
+    assert queries == set()
+
+def test_queries_in_eval_is_dry():
+    fb = FwdBucket()
+    pkt = Packet({'inport':1})
+    queries, pkts = queries_in_eval((set(), {pkt}), match(inport=1) >> fb)
+    assert queries == {fb}
+    assert fb.bucket == set()
+
+def test_compile_eval_collects_queries():
+    fb = FwdBucket()
+    pol_eval = ((match(inport=1) >> fb) + fwd(2)).compile_eval()
+    pkt = Packet({'inport':1})
+    queries = set()
+    assert pol_eval(pkt, queries) == {pkt.modify(outport=2)}
+    assert queries == {fb}
+
+def test_track_eval_derived_eval_override():
+    class tap(DerivedPolicy):
+        def eval(self, pkt):
+            self.policy.eval(pkt)
+            return {pkt}
+    fb = FwdBucket()
+    pol = tap(match(inport=1) >> fb)
+    pkt = Packet({'inport':1})
+    assert pol.track_eval(pkt) == ({pkt}, {fb})
+    assert fb.bucket == {pkt}
+    queries = set()
+    assert (pol + drop).compile_eval()(pkt, queries) == {pkt}
+    assert queries == {fb}
+
+# Dispatch on exact matches
+
+def test_parallel_dispatch_index():
+    pol = parallel([match(switch=s) >> fwd(s) for s in range(10)] +
+                   [match(inport=1) >> fwd(100)])
+    field, table, rest = pol.dispatch_index()
+    assert field == 'switch'
+    assert len(table) == 10
+    assert rest == [pol.policies[-1]]
+
+def test_parallel_dispatch_eval():
+    pol = parallel([match(switch=s) >> fwd(s) for s in range(10)] +
+                   [match(inport=1) >> fwd(100)])
+    pkt = Packet({'switch':3, 'inport':1})
+    expected = {pkt.modify(outport=3), pkt.modify(outport=100)}
+    assert pol.eval(pkt) == expected
+    assert pol.compile_eval()(pkt) == expected
+    pkt = Packet({'inport':1})
+    assert pol.eval(pkt) == {pkt.modify(outport=100)}
+    assert pol.compile_eval()(pkt) == {pkt.modify(outport=100)}
+
+# Longest prefix match
+
+def test_prefix_trie():
+    trie = PrefixTrie([(IPPrefix('10.0.0.0/8'), 1),
+                       (IPPrefix('10.1.0.0/16'), 2),
+                       ('10.1.2.3', 3)])
+    assert len(trie) == 3
+    assert trie.longest_match(IPAddr('10.1.2.3')) == 3
+    assert trie.longest_match(IPAddr('10.1.2.4')) == 2
+    assert trie.longest_match('10.2.0.1') == 1
+    assert trie.longest_match('11.0.0.1', 0) == 0
+    assert [repr(p) for (p, v) in trie.items()] == \
+        ['10.1.2.3/32', '10.1.0.0/16', '10.0.0.0/8']
+
+def test_lpm():
+    pol = lpm({IPPrefix('10.0.0.0/8') : fwd(1),
+               IPPrefix('10.1.0.0/16') : fwd(2)}, default=fwd(3))
+    for (ip, port) in [('10.1.0.1', 2), ('10.2.0.1', 1), ('11.0.0.1', 3)]:
+        pkt = Packet({'dstip' : IPAddr(ip)})
+        expected = {pkt.modify(outport=port)}
+        assert pol.eval(pkt) == expected
+        assert pol.compile_eval()(pkt) == expected
+        assert pol.compile().eval(pkt) == expected
+    pkt = Packet({'inport' : 1})
+    assert pol.eval(pkt) == {pkt.modify(outport=3)}
+
+# MAC table
+
+def test_mac_table():
+    from pyretic.modules.mac_learner import mac_table
+    table = mac_table(fwd(9), timeout=10, max_entries=2)
+    mac1, mac2, mac3 = [EthAddr('00:00:00:00:00:0%d' % i) for i in (1,2,3)]
+    pkt = Packet({'switch' : 1, 'dstmac' : mac1})
+    assert table.eval(pkt) == {pkt.modify(outport=9)}
+    assert table.learn(1, mac1, 3, now=0) == []
+    assert table.lookup(pkt, now=5) == 3
+    assert table.lookup(pkt, now=10) is None
+    table.learn(1, mac2, 4, now=1)
+    assert table.learn(1, mac3, 5, now=2) == [(1, mac1)]
+    assert table.learn(1, mac3, 5, now=12) == [(1, mac2)]
+    table = mac_table(fwd(9))
+    table.learn(1, mac1, 3)
+    table.learn(2, mac1, 4)
+    classifier = table.compile()
+    assert len(classifier) == 3
+    assert classifier.eval(pkt) == {pkt.modify(outport=3)}
+
+def test_mac_table_expiry():
+    import time
+    from pyretic.modules.mac_learner import mac_table
+    removed = []
+    table = mac_table(fwd(9), timeout=0.05, on_remove=removed.extend)
+    mac = EthAddr('00:00:00:00:00:01')
+    pkt = Packet({'switch' : 1, 'dstmac' : mac})
+    table.learn(1, mac, 3)
+    generation = table.compile_key()
+    time.sleep(0.06)
+    # reading neither removes entries nor changes the key
+    assert table.lookup(pkt) is None
+    assert len(table.compile()) == 1
+    assert table.policy == fwd(9)
+    assert table.compile_key() == generation and removed == []
+    table.attach(lambda: None)
+    time.sleep(0.1)
+    assert removed == [(1, mac)] and not table.entries
+    assert table.compile_key() != generation
+
+def test_mac_table_expiry_lock_order():
+    import threading
+    from pyretic.modules.mac_learner import mac_table
+    policy_lock = threading.RLock()     # STANDS IN FOR Runtime.policy_lock
+    def on_remove(keys):
+        with policy_lock:
+            pass
+    table = mac_table(fwd(9), timeout=0.001, on_remove=on_remove)
+    table.attach(lambda: policy_lock.acquire() and policy_lock.release())
+    def packet_in():
+        for i in range(300):
+            with policy_lock:
+                table.learn(1, EthAddr('00:00:00:00:00:%02x' % (i % 256)), 1)
+    def expiry():
+        for i in range(300):
+            table.expire()
+    threads = [threading.Thread(target=packet_in), threading.Thread(target=expiry)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert not any(t.is_alive() for t in threads)
+
+# Shared nodes
+
+def test_match_modify_interned():
+    assert match(switch=1, inport=2) is match(inport=2, switch=1)
+    assert match(switch=1) is not match(switch=True)
+    assert modify(outport=1) is fwd(1).policy
+    assert modify(outport=1) is not modify(outport=2)
+
+def test_interned_pickle():
+    import pickle
+    m = match(switch=1, dstmac=EthAddr('00:00:00:00:00:01'))
+    assert pickle.loads(pickle.dumps(m, 2)) is m
+    assert pickle.loads(pickle.dumps(modify(outport=3))) is modify(outport=3)
+
+def test_combinator_hash():
+    p1 = match(switch=1) >> fwd(1)
+    p2 = match(switch=1) >> fwd(1)
+    assert p1 == p2
+    assert hash(p1) == hash(p2)
+
+# Compile memoization
+
+def test_compile_memoized():
+    static = match(switch=1) >> fwd(1)
+    dyn = DynamicPolicy(fwd(2))
+    pol = static + (match(switch=2) >> dyn)
+    c1 = pol.compile()
+    assert pol.compile() is c1
+    assert static.compile_key() is None
+    dyn.policy = fwd(3)
+    c2 = pol.compile()
+    assert c2 is not c1
+    assert static.compile() is static.compile()
+    pkt = Packet({'switch' : 2})
+    assert c2.eval(pkt) == {pkt.modify(outport=3)}
+
+# Indexed parallel composition
+
+def test_rule_index_candidates():
+    from pyretic.core.language import _RuleIndex
+    rules = [Rule(match(switch=1), [identity]),
+             Rule(match(switch=2), [identity]),
+             Rule(match(inport=1), [identity]),
+             Rule(identity, [drop])]
+    index = _RuleIndex(rules)
+    assert index.field == 'switch'
+    assert list(index.candidates(match(switch=2))) == [1, 2, 3]
+    assert list(index.candidates(match(inport=2))) == [0, 1, 2, 3]
+
+def test_rule_index_prefixes():
+    from pyretic.core.language import _RuleIndex
+    rules = [Rule(match(dstip=IPPrefix('10.0.0.0/8')), [identity]),
+             Rule(match(dstip=IPAddr('10.0.0.1')), [identity]),
+             Rule(match(dstip=IPAddr('11.0.0.1')), [identity])]
+    index = _RuleIndex(rules)
+    assert list(index.candidates(match(dstip=IPAddr('10.0.0.1')))) == [0, 1]
+    assert list(index.candidates(match(dstip=IPPrefix('11.0.0.0/8')))) == [2]
+
+def test_parallel_disjoint_compile():
+    pol = parallel([match(dstip=IPAddr('10.0.0.%d' % i)) >> fwd(i)
+                    for i in range(1, 6)])
+    classifier = pol.compile()
+    assert len(classifier) == 6
+    pkt = Packet({'dstip' : IPAddr('10.0.0.3')})
+    assert classifier.eval(pkt) == {pkt.modify(outport=3)}
+
+def test_remove_shadowed_indexed():
+    rules = [Rule(match(switch=1, dstip=IPPrefix('10.0.0.0/8')), [identity]),
+             Rule(match(switch=1, dstip=IPAddr('10.0.0.1'), inport=2), [drop]),
+             Rule(match(switch=2, dstip=IPAddr('10.0.0.1')), [drop]),
+             Rule(match(switch=2), [identity]),
+             Rule(match(switch=2, inport=3), [drop]),
+             Rule(identity, [drop]),
+             Rule(match(inport=1), [identity])]
+    assert Classifier(rules).optimize().rules == [rules[0], rules[2],
+                                                  rules[3], rules[5]]
+
+def test_remove_shadowed_string_mac():
+    c1 = Classifier([Rule(match(srcmac='00:00:00:00:00:01'), [modify(outport=1)]),
+                     Rule(identity, [drop])])
+    c2 = Classifier([Rule(match(srcmac=EthAddr('00:00:00:00:00:01')),
+                          [modify(outport=2)]),
+                     Rule(identity, [drop])])
+    pkt = Packet({'srcmac' : EthAddr('00:00:00:00:00:01')})
+    assert (c1 + c2).eval(pkt) == {pkt.modify(outport=2)}
+
+# Classifier lookup
+
+def test_classifier_index():
+    classifier = Classifier([
+        Rule(match(switch=1, dstip=IPAddr('10.0.0.1')), [modify(outport=1)]),
+        Rule(match(dstip=IPPrefix('10.0.0.0/8')), [modify(outport=2)]),
+        Rule(match(inport=None), [modify(outport=3)]),
+        Rule(identity, [drop])])
+    index = classifier.build_index()
+    pkts = [Packet({'switch' : 1, 'dstip' : IPAddr('10.0.0.1'), 'inport' : 1}),
+            Packet({'switch' : 2, 'dstip' : IPAddr('10.0.0.1'), 'inport' : 1}),
+            Packet({'switch' : 2, 'dstip' : IPAddr('11.0.0.1'), 'inport' : 1}),
+            Packet({'switch' : 2, 'dstip' : IPAddr('11.0.0.1')})]
+    for pkt in pkts:
+        assert index.eval(pkt) == classifier.eval(pkt)
+    assert [index.lookup(pkt) for pkt in pkts] == [0, 1, 3, 2]
+
+def test_classifier_index_string_mac():
+    classifier = Classifier([
+        Rule(match(srcmac='00:00:00:00:00:01'), [modify(outport=1)]),
+        Rule(match(srcmac=EthAddr('00:00:00:00:00:01')), [modify(outport=2)]),
+        Rule(identity, [drop])])
+    index = classifier.build_index()
+    pkt = Packet({'srcmac' : EthAddr('00:00:00:00:00:01')})
+    assert index.lookup(pkt) == 1
+    assert index.eval(pkt) == classifier.eval(pkt)
+
+def test_classifier_index_not_total():
+    index = Classifier([Rule(match(switch=1), [identity])]).build_index()
+    with pytest.raises(TypeError):
+        index.eval(Packet({'switch' : 2}))
+
+# Integer-backed addresses
+
+def test_ip_prefix_equality():
+    assert IPPrefix('10.0.0.0/8') == IPPrefix('10.1.2.3/8')
+    assert IPPrefix('10.0.0.0/8') != IPPrefix('10.0.0.0/16')
+    assert hash(IPPrefix('10.0.0.0/8')) == hash(IPPrefix('10.1.2.3/8'))
+    assert IPPrefix('10.0.0.0/8') == IPAddr('10.200.0.1')
+    assert IPAddr('10.0.0.1') == IPAddr('\x0a\x00\x00\x01')
+
+def test_ip_covers_and_intersect():
+    m8 = match(dstip=IPPrefix('10.0.0.0/8'))
+    m16 = match(dstip=IPPrefix('10.1.0.0/16'))
+    m32 = match(dstip=IPAddr('10.1.0.1'))
+    assert m8.covers(m16) and m16.covers(m32) and m8.covers(m8)
+    assert not m16.covers(m8)
+    assert not m16.covers(match(dstip=IPAddr('10.2.0.1')))
+    assert m8.intersect(m32) == m32
+    assert m16.intersect(match(dstip=IPPrefix('10.2.0.0/16'))) == drop
+
+def test_address_interning():
+    import pickle
+    mac = EthAddr('00:00:00:00:00:0a')
+    assert EthAddr('00:00:00:00:00:0A') is mac
+    assert EthAddr('\x00\x00\x00\x00\x00\x0a') is mac
+    assert MAC(mac) == mac and hash(MAC(mac)) == hash(mac)
+    assert pickle.loads(pickle.dumps(mac, 2)) is mac
+    ip = IPAddr('10.0.0.1')
+    assert IPAddr('\x0a\x00\x00\x01') is ip
+    assert pickle.loads(pickle.dumps(ip)) is ip
+    assert repr(mac) == '00:00:00:00:00:0a' and repr(ip) == '10.0.0.1'
+
+# Packets
+
+def test_packet_modify():
+    pkt = Packet({'switch' : 1, 'inport' : 2})
+    moved = pkt.modify(outport=3, inport=None)
+    assert moved == Packet({'switch' : 1, 'outport' : 3})
+    assert hash(moved) == hash(Packet({'outport' : 3, 'switch' : 1}))
+    assert moved.header == util.frozendict(switch=1, outport=3)
+    assert sorted(moved.available_fields()) == ['outport', 'switch']
+    with pytest.raises(KeyError):
+        moved['inport']
+    with pytest.raises(KeyError):
+        moved.modify(inport=None)
+
+def test_packet_modify_copies_fields():
+    pkt = Packet({'switch' : 1, 'inport' : 2})
+    assert pkt.modify(outport='inport')['outport'] == 2
+
+def test_packet_pickle():
+    import pickle
+    pkt = Packet({'switch' : 1, 'srcmac' : EthAddr('00:00:00:00:00:01')})
+    assert pickle.loads(pickle.dumps(pkt, 2)) == pkt
+
+# Ternary encoding
+
+def test_match_ternary():
+    m = match(switch=1, dstip=IPPrefix('10.0.0.0/8'))
+    value, mask = m.ternary()
+    assert value & mask == value
+    assert match(switch='1').ternary() is None
+    assert match(vswitch=1).ternary() is None
+    both = m.intersect(match(dstip=IPAddr('10.0.0.1'), inport=2))
+    assert both == match(switch=1, dstip=IPAddr('10.0.0.1'), inport=2)
+    assert both.ternary() == (value | both.ternary()[0], mask | both.ternary()[1])
+    assert m.covers(both) and not both.covers(m)
+    assert m.intersect(match(switch=2)) == drop
+
+# Normalization
+
+def test_normalize_flattens_and_folds():
+    pol = (identity >> (match(switch=1) >> match(inport=2))) >> \
+          (modify(outport=1) >> modify(srcport=3))
+    assert normalize(pol) == (match(switch=1, inport=2) >>
+                              modify(outport=1, srcport=3))
+    assert normalize(match(switch=1) >> match(switch=2) >> fwd(1)) == drop
+    assert normalize(drop + (match(switch=1) >> fwd(1))) == \
+        (match(switch=1) >> modify(outport=1))
+    assert normalize(union([match(switch=1), identity])) == identity
+
+def test_normalize_keeps_queries_and_input():
+    q = FwdBucket()
+    pol = q >> drop
+    assert normalize(pol) == pol
+    inner = match(switch=1) >> fwd(2)
+    pol = if_(identity, inner, drop)
+    assert normalize(pol) == (match(switch=1) >> modify(outport=2))
+    assert pol.t_branch is inner
+    unchanged = match(switch=1) >> q
+    assert normalize(unchanged) is unchanged
+
+def test_normalize_same_eval():
+    pol = if_(match(switch=1), fwd(1) >> identity,
+              (match(inport=3) >> modify(outport=1)) + (identity >> drop))
+    pkt = Packet({'switch' : 1, 'inport' : 3})
+    assert normalize(pol).eval(pkt) == pol.eval(pkt)
+    assert normalize(pol).compile().eval(pkt) == pol.compile().eval(pkt)
+
+def test_if_compile_restricts_branches():
+    pol = if_(match(switch=1) | match(inport=2), fwd(1), fwd(2))
+    c = pol.compile()
+    for sw in (1, 2):
+        for port in (1, 2, 3):
+            pkt = Packet({'switch' : sw, 'inport' : port})
+            assert c.eval(pkt) == pol.eval(pkt)
+
+def test_if_compile_nested_chain():
+    pol = drop
+    for i in range(30):
+        pol = if_(match(switch=i), fwd(i), pol)
+    c = pol.compile()
+    assert len(c) == 31
+    assert c.eval(Packet({'switch' : 7})) == {Packet({'switch' : 7, 'outport' : 7})}
+    assert c.eval(Packet({'switch' : 70})) == set()
+
+def test_xflood():
+    pol = xflood([3, 1, 2])
+    c = pol.compile()
+    assert len(c) == 4
+    for inport in (1, 2, 3, 4):
+        pkt = Packet({'switch' : 1, 'inport' : inport})
+        expected = parallel(map(xfwd, [1, 2, 3])).eval(pkt)
+        assert pol.eval(pkt) == expected
+        assert c.eval(pkt) == expected
+    assert xflood([1]).compile().eval(Packet({'inport' : 1})) == set()
+
+def test_policy_pickle():
+    import pickle
+    pol = if_(match(switch=1), fwd(1) + Controller, xflood([1, 2])) >> \
+          lpm({IPPrefix('10.0.0.0/8') : identity}, default=drop)
+    copy = pickle.loads(pickle.dumps(pol, 2))
+    assert copy == pol
+    assert pickle.loads(pickle.dumps(identity, 2)) is identity
+    assert pickle.loads(pickle.dumps(pol.compile(), 2)) == pol.compile()
+
+def test_compile_processes():
+    from pyretic.core import language
+    def make():
+        return parallel([match(switch=s) >> (if_(match(inport=1), fwd(2), fwd(1)) +
+                                             xflood([1, 2, 3]))
+                         for s in range(8)] + [FwdBucket()])
+    expected = make().compile()
+    set_compile_processes(2)
+    try:
+        pol = make()
+        c = pol.compile()
+    finally:
+        set_compile_processes(None)
+    assert language._compile_pool is None
+    assert c == expected
+    assert pol.policies[0]._compiled is not None
+
+def test_switch_slices():
+    c = Classifier([Rule(match(switch=1, inport=2), [modify(outport=1)]),
+                    Rule(match(switch=2), [Controller]),
+                    Rule(match(dstport=80), [modify(outport=3)]),
+                    Rule(identity, [drop])])
+    slices = c.switch_slices([1, 2, 3])
+    assert len(slices[1]) == 3
+    assert slices[2].rules == [Rule(match(switch=2), [Controller])]
+    assert slices[3].rules == [Rule(match(switch=3, dstport=80), [modify(outport=3)]),
+                               Rule(match(switch=3), [drop])]
+    for s in (1, 2, 3):
+        pkt = Packet({'switch' : s, 'inport' : 2, 'dstport' : 80})
+        assert slices[s].eval(pkt) == c.eval(pkt)
+
+def test_switch_slices_reused():
+    general = [Rule(match(dstport=80), [modify(outport=3)]),
+               Rule(identity, [drop])]
+    old = Classifier([Rule(match(switch=1), [modify(outport=1)])] + general)
+    old_slices = old.switch_slices([1, 2, 3])
+    new = Classifier([Rule(match(switch=1), [modify(outport=2)]),
+                      Rule(match(switch=3, inport=1), [Controller])] + general)
+    slices = new.switch_slices([1, 2, 3, 4], old, old_slices)
+    assert slices[2] is old_slices[2]
+    assert slices == new.switch_slices([1, 2, 3, 4])
+    changed = Classifier(new.rules[:2] + [Rule(identity, [Controller])])
+    slices = changed.switch_slices([1, 2], new, new.switch_slices([1, 2]))
+    assert slices == changed.switch_slices([1, 2])
+
+def test_if_compile_empty_actions_not_taken():
+    class empty_pred(DerivedPolicy, Filter):
+        def __init__(self):
+            super(empty_pred, self).__init__(identity)
+        def compile(self):
+            return Classifier([Rule(identity, [])])
+    pol = if_(empty_pred(), fwd(1), fwd(2))
+    assert pol.compile().eval(Packet({'switch' : 1})) == \
+        {Packet({'switch' : 1, 'outport' : 2})}
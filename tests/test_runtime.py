@@ -0,0 +1,104 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+
+from pyretic.core.runtime import group_switch_rules
+
+import pytest
+
+### Rule batching ###
+
+def test_group_switch_rules():
+    rules = [({'switch' : 1, 'dstport' : 80}, 100, [{'outport' : 2}]),
+             ({'switch' : 1, 'dstport' : 22}, 99, [{'outport' : 2}]),
+             ({'switch' : 2, 'dstport' : 80}, 100, [{'outport' : 2}]),
+             ({'switch' : 3, 'dstport' : 80}, 100, [{'outport' : 3}]),
+             ({'switch' : 3, 'dstport' : 80}, 90, [{'outport' : 2}])]
+    assert group_switch_rules(rules) == [
+        [[1, 2], {'dstport' : 80}, 100, [{'outport' : 2}]],
+        [[1], {'dstport' : 22}, 99, [{'outport' : 2}]],
+        [[3], {'dstport' : 80}, 100, [{'outport' : 3}]],
+        [[3], {'dstport' : 80}, 90, [{'outport' : 2}]]]
+    # the input rules are left alone
+    assert rules[0][0] == {'switch' : 1, 'dstport' : 80}
+
+def test_group_switch_rules_deletes():
+    rules = [({'switch' : s}, 0) for s in (3, 1, 2)]
+    assert group_switch_rules(rules) == [[[3, 1, 2], {}, 0]]
+    assert group_switch_rules([]) == []
+
+### Priority allocation ###
+
+from pyretic.core.runtime import allocate_priorities, _decreasing_run
+
+def check_priorities(priorities, top=60000, bottom=0):
+    assert all(p > q for (p, q) in zip(priorities, priorities[1:]))
+    assert all(bottom < p <= top for p in priorities)
+
+def test_decreasing_run():
+    assert _decreasing_run([]) == []
+    assert _decreasing_run([None, None]) == []
+    assert _decreasing_run([9, None, 5, 7, 1]) in ([0, 2, 4], [0, 3, 4])
+    assert _decreasing_run([1, 2, 3]) in ([0], [1], [2])
+
+def test_allocate_fresh():
+    priorities = allocate_priorities(range(100), {})
+    check_priorities(priorities)
+    assert priorities[0] < 60000    # room left above the first rule
+
+def test_allocate_insert_is_stable():
+    keys = range(1000)
+    old = dict(zip(keys, allocate_priorities(keys, {})))
+    for position in (0, 1, 500, 1000):
+        new_keys = keys[:position] + ['new'] + keys[position:]
+        priorities = allocate_priorities(new_keys, old)
+        check_priorities(priorities)
+        changed = [k for (k, p) in zip(new_keys, priorities) if old.get(k) != p]
+        assert changed == ['new']
+
+def test_allocate_move_and_delete():
+    keys = range(50)
+    old = dict(zip(keys, allocate_priorities(keys, {})))
+    new_keys = [49] + range(1, 49)
+    priorities = allocate_priorities(new_keys, old)
+    check_priorities(priorities)
+    assert sum(1 for (k, p) in zip(new_keys, priorities) if old[k] != p) == 1
+
+def test_allocate_renumbers_when_out_of_room():
+    old = {'a' : 10, 'b' : 9}
+    priorities = allocate_priorities(['a', 'new', 'b'], old, top=20, bottom=0)
+    check_priorities(priorities, top=20)
+    assert priorities[0] != 10 or priorities[2] != 9
+    # with room, the old priorities are kept
+    assert allocate_priorities(['a', 'new', 'b'], {'a' : 10, 'b' : 5},
+                               top=20, bottom=0) == [10, 8, 5]
+
+def test_allocate_too_many_rules():
+    check_priorities(allocate_priorities(range(20), {}, top=20, bottom=0), top=20)
+    with pytest.raises(ValueError):
+        allocate_priorities(range(21), {}, top=20, bottom=0)